@@ -0,0 +1,74 @@
+#
+# bench_memory.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+"""Measures the memory used by a flattened C++ template with many members.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_memory.py [--classes N] [--members N]
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import scope                # pylint: disable-msg=C0413
+import scope.lang.cpp as cpp  # pylint: disable-msg=C0413
+
+
+def build_template(classes, members):
+    """C++ file with the given number of classes, each one with an attribute
+    and a getter for each member."""
+    return cpp.tfile[
+        scope.for_each(range(0, classes), lambda c: cpp.tclass(
+            'Class{0}'.format(c)
+        )[
+            scope.for_each(range(0, members), lambda m: scope.span[
+                cpp.tattribute('int', '_member{0}'.format(m)),
+                cpp.tmethod('int', 'GetMember{0}'.format(m),
+                            visibility=cpp.PUBLIC, const=True)[
+                    'return _member{0};'.format(m)
+                ]
+            ])
+        ])
+    ]
+
+
+def measure(classes, members):
+    """Returns the number of nodes and the bytes allocated by the flattened
+    template."""
+    gc.collect()
+    tracemalloc.start()
+    flattened = scope.flatten(build_template(classes, members))
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    nodes = classes * (1 + 2 * members) + 1
+    del flattened
+    return nodes, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--classes', type=int, default=100)
+    parser.add_argument('--members', type=int, default=500)
+    args = parser.parse_args()
+
+    nodes, size = measure(args.classes, args.members)
+    print('nodes: {0}'.format(nodes))
+    print('memory: {0:.1f} MB'.format(size / 1048576.0))
+    print('bytes per node: {0:.0f}'.format(float(size) / nodes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+#
+# bench_serialize.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+"""Benchmarks flatten and serialize for several shapes of templates.
+
+Run from the root of the repository:
+
+    python benchmarks/bench_serialize.py [--scale F] [--repeat N]
+        [--shapes wide,deep,cpp,span] [--output results.json]
+        [--compare previous.json]
+
+For each shape it reports the time of flatten and serialize, as nodes per
+second and output megabytes per second, and the peak memory of a complete
+serialization. The results can be written as JSON and compared with the
+results of another version.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import scope                # pylint: disable-msg=C0413
+import scope.lang.cpp as cpp  # pylint: disable-msg=C0413
+
+
+def wide_template(scale):
+    """Single tag with a for_each over a million strings."""
+    count = int(1000000 * scale)
+    return cpp.tfile[
+        scope.for_each(range(0, count), lambda n: 'line {0};'.format(n))
+    ]
+
+
+def deep_template(scale):
+    """Chains of nested namespaces and indent blocks. The depth is limited by
+    the recursion of the serialization."""
+    depth = 100
+
+    def chain(n):
+        template = 'int value{0};'.format(n)
+        for level in range(0, depth):
+            if level % 2:
+                template = scope.indent[template]
+            else:
+                template = cpp.tnamespace('n{0}'.format(level))[template]
+        return template
+
+    return cpp.tfile[
+        scope.for_each(range(0, int(1000 * scale)), chain)
+    ]
+
+
+def cpp_template(scale):
+    """Many classes with attributes and methods."""
+    def member(m):
+        return scope.span[
+            cpp.tattribute('std::string', '_member{0}'.format(m)),
+            cpp.tmethod('const std::string &', 'GetMember{0}'.format(m),
+                        visibility=cpp.PUBLIC, const=True)[
+                'return _member{0};'.format(m)
+            ],
+            cpp.tmethod('void', 'SetMember{0}'.format(m),
+                        ['const std::string & value'],
+                        visibility=cpp.PUBLIC)[
+                '_member{0} = value;'.format(m)
+            ]
+        ]
+
+    return cpp.tfile[
+        '#include <string>',
+        cpp.tnamespace('generated')[
+            scope.for_each(range(0, int(2000 * scale)), lambda c: cpp.tclass(
+                'Class{0}'.format(c), superclasses=[(cpp.PUBLIC, 'Base')]
+            )[
+                cpp.tctor('Class{0}'.format(c), visibility=cpp.PUBLIC)[
+                    scope.nothing
+                ],
+                scope.for_each(range(0, 20), member)
+            ])
+        ]
+    ]
+
+
+def span_template(scale):
+    """Strings grouped in nested span blocks."""
+    def group(n):
+        return scope.span[
+            'a{0};'.format(n),
+            scope.span[
+                'b{0};'.format(n),
+                scope.span['c{0};'.format(n), scope.nothing],
+                'd{0};'.format(n)
+            ],
+            scope.span
+        ]
+
+    return cpp.tfile[
+        scope.for_each(range(0, int(200000 * scale)), group)
+    ]
+
+
+SHAPES = [
+    ('wide', wide_template),
+    ('deep', deep_template),
+    ('cpp', cpp_template),
+    ('span', span_template),
+]
+
+
+def count_nodes(tree):
+    """Number of elements and strings in a flattened tree."""
+    count = 0
+    pending = [tree]
+    while pending:
+        node = pending.pop()
+        count += 1
+        if isinstance(node, scope.TagBase):
+            pending.extend(node.children)
+    return count
+
+
+def best_time(function, repeat):
+    """Best time of several runs, and the result of the last one."""
+    best = None
+    result = None
+    for _ in range(0, repeat):
+        gc.collect()
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def peak_memory(function):
+    """Peak of the memory allocated while running the function, or None if
+    it can't be measured."""
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_shape(factory, scale, repeat):
+    """Measures a shape of template."""
+    flatten_time, tree = best_time(lambda: scope.flatten(factory(scale)),
+                                   repeat)
+    nodes = count_nodes(tree)
+    serialize_time, output = best_time(lambda: scope.serialize(tree), repeat)
+    megabytes = len(output) / 1048576.0
+    del tree, output
+    peak = peak_memory(lambda: scope.serialize(factory(scale)))
+    return {
+        'nodes': nodes,
+        'output_mb': megabytes,
+        'flatten_s': flatten_time,
+        'serialize_s': serialize_time,
+        'flatten_nodes_per_s': nodes / flatten_time,
+        'serialize_nodes_per_s': nodes / serialize_time,
+        'serialize_mb_per_s': megabytes / serialize_time,
+        'peak_memory_mb': None if peak is None else peak / 1048576.0,
+    }
+
+
+def print_results(results, previous=None):
+    """Prints a table with the results, and the ratio with the previous
+    results if provided."""
+    columns = [
+        ('flatten_nodes_per_s', 'flatten nodes/s'),
+        ('serialize_nodes_per_s', 'serialize nodes/s'),
+        ('serialize_mb_per_s', 'serialize MB/s'),
+        ('peak_memory_mb', 'peak MB'),
+    ]
+    print('{0:<6} {1:>10}'.format('shape', 'nodes') + ''.join(
+        ' {0:>20}'.format(title) for _, title in columns))
+    for name, result in sorted(results['shapes'].items()):
+        line = '{0:<6} {1:>10}'.format(name, result['nodes'])
+        for key, _ in columns:
+            value = result[key]
+            if value is None:
+                cell = '-'
+            else:
+                cell = '{0:.2f}'.format(value)
+                old = (previous or {}).get('shapes', {}).get(name, {})
+                if old.get(key):
+                    cell += ' ({0:.2f}x)'.format(value / old[key])
+            line += ' {0:>20}'.format(cell)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='factor applied to the size of the templates')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the best time is reported')
+    parser.add_argument('--shapes', default=','.join(n for n, _ in SHAPES),
+                        help='comma separated list of shapes to run')
+    parser.add_argument('--output', help='file for the JSON results')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    args = parser.parse_args()
+
+    selected = args.shapes.split(',')
+    results = {
+        'python': platform.python_version(),
+        'scale': args.scale,
+        'shapes': dict((name, run_shape(factory, args.scale, args.repeat))
+                       for name, factory in SHAPES if name in selected),
+    }
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
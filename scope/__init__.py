@@ -6,3 +6,10 @@
 #
 
 from .scope import *
+
+import sys as _sys
+# The binary format uses memory views of mapped files, from Python 3.
+if _sys.version_info >= (3, 0):
+    from .binary import *
+if _sys.version_info >= (3, 5):
+    from .aio import *
@@ -0,0 +1,99 @@
+#
+# _aio_cases.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+# pylint: disable=C0111
+
+"""Tests of the asynchronous serialization, imported by test_aio on the
+versions of Python supporting their syntax."""
+
+import asyncio
+import io
+import unittest
+from . import scope
+from . import aio
+from . import binary
+from .test_scope import mock_tag
+
+
+async def _rows(count):
+    for n in range(0, count):
+        await asyncio.sleep(0)
+        yield n
+
+
+class TestAsyncSerialization(unittest.TestCase):  # pylint: disable-msg=R0904
+    def _template(self, count):
+        return mock_tag(name='parent')[
+            aio.async_for_each(_rows(count), lambda n: mock_tag(
+                name='child-{0}'.format(n)
+            )[
+                scope.for_each(range(0, 2), lambda m: 'item-{0}'.format(m))
+            ]),
+            'end'
+        ]
+
+    def _expected(self, count):
+        return scope.serialize(mock_tag(name='parent')[
+            scope.for_each(range(0, count), lambda n: mock_tag(
+                name='child-{0}'.format(n)
+            )[
+                scope.for_each(range(0, 2), lambda m: 'item-{0}'.format(m))
+            ]),
+            'end'
+        ])
+
+    def test_aserialize_1(self):
+        output = asyncio.run(aio.aserialize(self._template(5)))
+
+        self.assertEqual(output, self._expected(5))
+
+    def test_aserialize_2(self):
+        written = []
+
+        class Sink(object):
+            async def write(self, string):
+                await asyncio.sleep(0)
+                written.append(string)
+
+        result = asyncio.run(aio.aserialize(self._template(2000), Sink()))
+
+        self.assertEqual(result, None)
+        self.assertTrue(len(written) > 1)
+        self.assertEqual(''.join(written), self._expected(2000))
+
+    def test_aserialize_3(self):
+        class FailingTag(scope.TagBase):
+            def serialize(self, context):
+                raise ValueError('failure')
+
+        template = mock_tag(name='parent')[
+            aio.async_for_each(_rows(3), lambda n: 'row'),
+            scope.Tag(FailingTag)
+        ]
+
+        self.assertRaises(ValueError, asyncio.run, aio.aserialize(template))
+
+    def test_aserialize_4(self):
+        class Sink(object):
+            def write(self, string):
+                raise IOError('failure')
+
+        self.assertRaises(IOError, asyncio.run,
+                          aio.aserialize(self._template(5000), Sink()))
+
+    def test_aserialize_5(self):
+        self.assertRaises(RuntimeError, scope.serialize, self._template(1))
+
+    def test_aserialize_6(self):
+        self.assertRaises(RuntimeError, scope.freeze, self._template(1))
+        self.assertRaises(RuntimeError, binary.dump, self._template(1),
+                          io.BytesIO())
+
+    def test_exports_1(self):
+        from . import aserialize, async_for_each
+        self.assertTrue(aserialize is aio.aserialize)
+        self.assertTrue(async_for_each is aio.async_for_each)
@@ -0,0 +1,136 @@
+#
+# aio.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+"""Asynchronous serialization of templates, for Python 3.5+."""
+
+import asyncio
+import inspect
+
+from . import scope
+
+__all__ = ['AsyncForEachTag', 'aserialize', 'async_for_each']
+
+
+class AsyncForEachTag(scope.LazyForEachTag):
+    """Represents a for_each block over an asynchronous iterable. Like the
+    lazy for_each, it is expanded during the serialization, one item at a
+    time, so it can only be serialized by aserialize. It can't be frozen or
+    dumped either."""
+
+    __slots__ = ()
+
+    def _items(self, context):
+        loop = getattr(context, 'loop', None)
+        if loop is None:
+            raise RuntimeError('async_for_each can only be serialized with '
+                               'aserialize.')
+        return self._fetch_items(loop)
+
+    def _fetch_items(self, loop):
+        """Generates the items, fetched in the event loop."""
+        iterator = self._iterable.__aiter__()
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(
+                    _next_item(iterator), loop).result()
+            except StopAsyncIteration:
+                return
+
+
+def async_for_each(elements, function):
+    """Allows to generate a tag for each item in an asynchronous iterable.
+    The items are requested while the template is serialized."""
+    return AsyncForEachTag(elements, function)
+
+
+async def aserialize(template, sink=None, options=scope.SerializerOptions()):
+    """Serialize the provided template, awaiting the asynchronous iterables
+    of async_for_each blocks. The sink may be a file-like object with a
+    regular or a coroutine write method. The output is written to it while
+    the serialization goes on, and if no sink is provided, it is returned.
+
+    The serialization itself runs in the default executor of the event loop,
+    which stays free for fetching the items and writing the output."""
+    loop = asyncio.get_event_loop()
+    chunks = asyncio.Queue(_LoopSink.SIZE)
+    loop_sink = _LoopSink(chunks, loop)
+    task = loop.run_in_executor(None, loop_sink.run, template, options)
+
+    output = []
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is _LoopSink.END:
+                break
+            if sink is None:
+                output.append(chunk)
+            else:
+                result = sink.write(chunk)
+                if inspect.isawaitable(result):
+                    await result
+    except BaseException:
+        # Unblock the serialization, which stops on its next write.
+        loop_sink.cancelled = True
+        while not task.done():
+            try:
+                chunks.get_nowait()
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.01)
+        if not task.cancelled():
+            task.exception()
+        raise
+    await task
+    return ''.join(output) if sink is None else None
+
+
+async def _next_item(iterator):
+    return await iterator.__anext__()
+
+
+class _AsyncContext(scope.SerializerContext):
+    """Context of an asynchronous serialization, giving access to the event
+    loop."""
+
+    def __init__(self, options, sink, loop):
+        super(_AsyncContext, self).__init__(options, sink=sink)
+        self.loop = loop
+
+
+class _LoopSink(object):
+    """Sink handing the output of a serialization thread to a coroutine
+    running in the event loop."""
+
+    END = object()
+
+    # Maximum number of chunks waiting for the coroutine.
+    SIZE = 16
+
+    def __init__(self, chunks, loop):
+        self._chunks = chunks
+        self._loop = loop
+        self.cancelled = False
+
+    def run(self, template, options):
+        """Serialize the template into the queue."""
+        try:
+            context = _AsyncContext(options, self, self._loop)
+            context.serialize(scope._flatten_template(  # pylint: disable-msg=W0212
+                template, options))
+            context.flush()
+        finally:
+            if not self.cancelled:
+                self._put(_LoopSink.END)
+
+    def write(self, string):
+        """Hand a chunk of output to the coroutine."""
+        if self.cancelled:
+            raise RuntimeError('The serialization was cancelled.')
+        self._put(string)
+
+    def _put(self, item):
+        asyncio.run_coroutine_threadsafe(self._chunks.put(item),
+                                         self._loop).result()
@@ -0,0 +1,441 @@
+#
+# binary.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+"""Compact binary format for flattened templates.
+
+A file starts with a header and contains the elements of the tree, written
+after their children, followed by the tables of strings, pickled objects and
+tag types, and a trailer with the offsets of the tables and the root:
+
+    element:  type id (u32), children defined (u8), size of the attributes
+              (u32), attributes, number of children (u32), references to
+              the children (u64)
+    table:    number of entries (u32), offsets of the entries (u64), data
+
+The entries of the table of types are the string ids (u32) of the module and
+the name of a class, and of the names of the attributes of its elements, so
+the elements only contain the values of the attributes.
+
+The references to the children are offsets of elements, or ids of strings
+or objects, with the kind in the two lower bits. The attributes of the
+elements are encoded with a type code per value. Everything is read on
+demand, so a memory-mapped file is rendered without loading it first.
+
+Loading a file imports the modules of the tag classes named in it and
+unpickles its objects, so only files from trusted sources must be loaded.
+
+The module requires Python 3, for memory views of mapped files."""
+
+import mmap
+import pickle
+import struct
+import sys
+
+from . import scope
+
+__all__ = ['BinaryTemplate', 'dump', 'load']
+
+_MAGIC = b'SCOPEBIN'
+_VERSION = 1
+
+_HEADER = struct.Struct('<8sI')
+_TRAILER = struct.Struct('<QQQQ8s')
+_ELEMENT = struct.Struct('<IBI')
+_COUNT = struct.Struct('<I')
+_OFFSET = struct.Struct('<Q')
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+
+# Kinds of references, stored in the two lower bits.
+_REF_ELEMENT, _REF_STRING, _REF_OBJECT = range(3)
+
+# Codes of the encoded values.
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INTEGER = b'i'
+_REAL = b'f'
+_STRING = b's'
+_LIST = b'l'
+_TUPLE = b't'
+_DICT = b'd'
+_OBJECT = b'o'
+
+_INT_RANGE = (-(1 << 63), (1 << 63) - 1)
+
+
+def dump(template, fileobj):
+    """Writes the flattened template to a binary file object. Lazy for_each
+    blocks are expanded, and elements found several times in the tree are
+    written once."""
+    _Writer(fileobj).write(scope.flatten(template))
+
+
+def load(fileobj):
+    """Reads a template written by dump, from the current position of the
+    binary file object to its end, and returns its root BinaryTemplate. The
+    file is memory-mapped if possible, and the elements are decoded while
+    the template is flattened. With fused serialization, these are decoded
+    and released one at a time. The file is released by closing the
+    template, which can be used in a with statement, or directly if the
+    root is not an element. See the module documentation about trusting the
+    files."""
+    try:
+        fileno = fileobj.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        fileno = None
+    if fileno is None:
+        reader = _Reader(memoryview(fileobj.read()))
+    else:
+        mapped = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            reader = _Reader(view[fileobj.tell():], (view, mapped))
+        except Exception:
+            view.release()
+            mapped.close()
+            raise
+    root = reader.root()
+    if not isinstance(root, BinaryTemplate):
+        reader.close()
+    return root
+
+
+class BinaryTemplate(object):
+    """Element of a binary template, decoded when it is flattened."""
+
+    __slots__ = ('_reader', '_offset')
+
+    def __init__(self, reader, offset):
+        self._reader = reader
+        self._offset = offset
+
+    def __len__(self):
+        raise RuntimeError('Should not be used.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Releases the file of the template. None of its elements can be
+        decoded afterwards."""
+        self._reader.close()
+
+    def _open(self):
+        """Returns a new element and its children, still encoded."""
+        return self._reader.element(self._offset)
+
+    # The element is always new.
+    _open_copy = _open
+
+
+class _Table(object):
+    """Entries of a table, by their index."""
+
+    def __init__(self):
+        self._indexes = {}
+        self._entries = []
+
+    def index(self, key, entry):
+        """Returns the index of the entry for a key, adding it if needed."""
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._indexes[key] = len(self._entries)
+            self._entries.append(entry)
+        return index
+
+    def encode(self):
+        """Returns the encoded table."""
+        offsets = [0]
+        for entry in self._entries:
+            offsets.append(offsets[-1] + len(entry))
+        return b''.join([_COUNT.pack(len(self._entries)),
+                         struct.pack('<{0}Q'.format(len(offsets)), *offsets)]
+                        + self._entries)
+
+
+class _Writer(object):
+    """Writes a template into a binary file."""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._position = 0
+        self._strings = _Table()
+        self._objects = _Table()
+        self._types = _Table()
+        self._type_ids = {}
+
+    def write(self, root):
+        """Writes the tree, the tables and the trailer."""
+        self._write(_HEADER.pack(_MAGIC, _VERSION))
+        root_reference = self._reference(root, self._write_elements(root))
+        offsets = []
+        for table in (self._strings, self._objects, self._types):
+            offsets.append(self._position)
+            self._write(table.encode())
+        self._write(_TRAILER.pack(offsets[0], offsets[1], offsets[2],
+                                  root_reference, _MAGIC))
+
+    def _write(self, data):
+        self._fileobj.write(data)
+        self._position += len(data)
+
+    def _write_elements(self, root):
+        """Writes the elements of the tree after their children, without
+        recursion. Returns their offsets by id."""
+        offsets = {}
+        # Children of the elements, with the lazy for_each blocks expanded.
+        expanded = {}
+        stack = [(root, False)]
+        while stack:
+            tag, ready = stack.pop()
+            if not isinstance(tag, scope.TagBase) or id(tag) in offsets:
+                continue
+            if not ready:
+                children = expanded[id(tag)] = \
+                    scope._expand_lazy(tag.children)  # pylint: disable-msg=W0212
+                stack.append((tag, True))
+                stack.extend((child, False) for child in children)
+                continue
+            children = expanded.pop(id(tag))
+            offsets[id(tag)] = self._position
+            state = scope._tag_state(tag)  # pylint: disable-msg=W0212
+            state.pop('_children', None)
+            state.pop('_children_defined', None)
+            encoded = []
+            for value in state.values():
+                self._encode(value, encoded)
+            encoded = b''.join(encoded)
+            self._write(b''.join([
+                _ELEMENT.pack(self._type(tag.__class__, tuple(state)),
+                              1 if tag.children_defined else 0,
+                              len(encoded)),
+                encoded,
+                _COUNT.pack(len(children)),
+                struct.pack('<{0}Q'.format(len(children)),
+                            *[self._reference(child, offsets)
+                              for child in children])
+            ]))
+        return offsets
+
+    def _reference(self, value, offsets):
+        """Returns the reference to a child."""
+        if isinstance(value, scope.TagBase):
+            return offsets[id(value)] << 2 | _REF_ELEMENT
+        elif isinstance(value, str):
+            return self._string(value) << 2 | _REF_STRING
+        return self._object(value) << 2 | _REF_OBJECT
+
+    def _string(self, value):
+        return self._strings.index(value, value.encode('utf-8'))
+
+    def _object(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return self._objects.index(data, data)
+
+    def _type(self, class_, names):
+        key = (class_, names)
+        index = self._type_ids.get(key)
+        if index is None:
+            module = class_.__module__
+            name = getattr(class_, '__qualname__', class_.__name__)
+            if _find_class(module, name) is not class_:
+                raise TypeError('The class {0} can\'t be found as {1}.{2}.'
+                                .format(class_, module, name))
+            strings = [self._string(value)
+                       for value in (module, name) + names]
+            index = self._type_ids[key] = self._types.index(
+                key, struct.pack('<{0}I'.format(len(strings)), *strings))
+        return index
+
+    def _encode(self, value, output):
+        """Appends the encoding of an attribute value to the output."""
+        if value is None:
+            output.append(_NONE)
+        elif value is True:
+            output.append(_TRUE)
+        elif value is False:
+            output.append(_FALSE)
+        elif isinstance(value, str):
+            output.append(_STRING + _COUNT.pack(self._string(value)))
+        elif type(value) is int and \
+                _INT_RANGE[0] <= value <= _INT_RANGE[1]:
+            output.append(_INTEGER + _INT.pack(value))
+        elif type(value) is float:
+            output.append(_REAL + _FLOAT.pack(value))
+        elif type(value) in (list, tuple):
+            output.append((_LIST if type(value) is list else _TUPLE) +
+                          _COUNT.pack(len(value)))
+            for item in value:
+                self._encode(item, output)
+        elif type(value) is dict:
+            output.append(_DICT + _COUNT.pack(len(value)))
+            for key, item in value.items():
+                self._encode(key, output)
+                self._encode(item, output)
+        else:
+            output.append(_OBJECT + _COUNT.pack(self._object(value)))
+
+
+class _Reader(object):
+    """Decodes the elements of a binary template on demand."""
+
+    def __init__(self, data, resources=()):
+        # Views and mapping released when the reader is closed.
+        self._resources = (data,) + tuple(resources)
+        if len(data) < _HEADER.size + _TRAILER.size:
+            raise ValueError('The file is not a binary template.')
+        magic, version = _HEADER.unpack_from(data, 0)
+        strings, objects, types, self._root, trailer_magic = \
+            _TRAILER.unpack_from(data, len(data) - _TRAILER.size)
+        if magic != _MAGIC or trailer_magic != _MAGIC:
+            raise ValueError('The file is not a binary template.')
+        if version != _VERSION:
+            raise ValueError('Unsupported version of binary template: {0}.'
+                             .format(version))
+        self._data = data
+        self._strings = self._table(strings)
+        self._objects = self._table(objects)
+        self._types = self._table(types)
+
+    def root(self):
+        """Returns the root of the template."""
+        return self._child(self._root)
+
+    def close(self):
+        """Releases the data."""
+        self._data = None
+        for resource in self._resources:
+            if isinstance(resource, memoryview):
+                resource.release()
+            else:
+                resource.close()
+        self._resources = ()
+
+    def element(self, offset):
+        """Decodes an element, and returns it with its children."""
+        data = self._data
+        if data is None:
+            raise ValueError('The binary template is closed.')
+        type_id, defined, size = _ELEMENT.unpack_from(data, offset)
+        position = offset + _ELEMENT.size
+        class_, names = self._type(type_id)
+        state = {}
+        for name in names:
+            state[name], position = self._decode(position)
+        position = offset + _ELEMENT.size + size
+        count = _COUNT.unpack_from(data, position)[0]
+        references = struct.unpack_from('<{0}Q'.format(count), data,
+                                        position + _COUNT.size)
+        element = class_.__new__(class_)
+        element.__setstate__(state)
+        element.children = []
+        element.children_defined = bool(defined)
+        return element, [self._child(reference) for reference in references]
+
+    def _child(self, reference):
+        kind = reference & 3
+        if kind == _REF_ELEMENT:
+            return BinaryTemplate(self, reference >> 2)
+        elif kind == _REF_STRING:
+            return self._string(reference >> 2)
+        return self._object(reference >> 2)
+
+    def _table(self, offset):
+        """Returns the offsets of the entries and of the data of a table,
+        and the cache of its decoded entries."""
+        count = _COUNT.unpack_from(self._data, offset)[0]
+        entries = offset + _COUNT.size
+        return entries, entries + (count + 1) * _OFFSET.size, {}
+
+    def _entry(self, table, index):
+        """Returns the data of an entry of a table."""
+        entries, base, _ = table
+        start, end = struct.unpack_from('<QQ', self._data,
+                                        entries + index * _OFFSET.size)
+        return self._data[base + start:base + end].tobytes()
+
+    def _string(self, index):
+        cache = self._strings[2]
+        value = cache.get(index)
+        if value is None:
+            value = cache[index] = \
+                self._entry(self._strings, index).decode('utf-8')
+        return value
+
+    def _object(self, index):
+        cache = self._objects[2]
+        if index not in cache:
+            cache[index] = pickle.loads(self._entry(self._objects, index))
+        return cache[index]
+
+    def _type(self, index):
+        """Returns the class of a type and the names of its attributes."""
+        cache = self._types[2]
+        value = cache.get(index)
+        if value is None:
+            entry = self._entry(self._types, index)
+            strings = [self._string(string) for string in struct.unpack(
+                '<{0}I'.format(len(entry) // _COUNT.size), entry)]
+            class_ = _find_class(strings[0], strings[1])
+            if class_ is None:
+                raise ValueError('The class {0}.{1} can\'t be found.'.format(
+                    strings[0], strings[1]))
+            value = cache[index] = (class_, tuple(strings[2:]))
+        return value
+
+    def _decode(self, position):
+        """Decodes an attribute value. Returns it with the position of the
+        next value."""
+        data = self._data
+        code = data[position:position + 1].tobytes()
+        position += 1
+        if code == _NONE:
+            return None, position
+        elif code == _TRUE:
+            return True, position
+        elif code == _FALSE:
+            return False, position
+        elif code == _STRING:
+            index = _COUNT.unpack_from(data, position)[0]
+            return self._string(index), position + _COUNT.size
+        elif code == _INTEGER:
+            return _INT.unpack_from(data, position)[0], position + _INT.size
+        elif code == _REAL:
+            return _FLOAT.unpack_from(data, position)[0], \
+                position + _FLOAT.size
+        elif code == _OBJECT:
+            index = _COUNT.unpack_from(data, position)[0]
+            return self._object(index), position + _COUNT.size
+        count = _COUNT.unpack_from(data, position)[0]
+        position += _COUNT.size
+        if code == _DICT:
+            value = {}
+            for _ in range(0, count):
+                key, position = self._decode(position)
+                value[key], position = self._decode(position)
+            return value, position
+        items = []
+        for _ in range(0, count):
+            item, position = self._decode(position)
+            items.append(item)
+        return (items if code == _LIST else tuple(items)), position
+
+
+def _find_class(module, name):
+    """Returns the class with a qualified name in a module, or None."""
+    try:
+        __import__(module)
+        value = sys.modules[module]
+        for part in name.split('.'):
+            value = getattr(value, part)
+    except (ImportError, AttributeError):
+        return None
+    return value
@@ -7,13 +7,17 @@
 
 import scope
 
-class SingletonObject:
+class SingletonObject(object):
     def __init__(self, name):
         self._name = name
 
     def __repr__(self):
         return '<{0}>'.format(self._name)
 
+    def __reduce__(self):
+        # Pickled by name, so the identity is kept in other processes.
+        return self._name.upper()
+
 PUBLIC = SingletonObject('public')
 PRIVATE = SingletonObject('private')
 PROTECTED = SingletonObject('protected')
@@ -28,6 +32,12 @@ class _OptionsField(object):
     def __hash__(self):
         return hash(self._id)
 
+    def __eq__(self, other):
+        return isinstance(other, _OptionsField) and self._id == other._id
+
+    def __ne__(self, other):
+        return not self == other
+
     @property
     def id(self):
         return self._id
@@ -43,32 +53,89 @@ OPEN_BRACE_IN_NEW_LINE_FOR_NAMESPACES = _OptionsField(2, False)
 OMIT_COMMENT_AFTER_END_BRACE_TYPES = _OptionsField(3, False)
 OMIT_COMMENT_AFTER_END_BRACE_NAMESPACES = _OptionsField(4, False)
 
+# All the option fields, in order of id.
+_FIELDS = (
+    OPEN_BRACE_IN_NEW_LINE_FOR_TYPES,
+    OPEN_BRACE_IN_NEW_LINE_FOR_METHODS,
+    OPEN_BRACE_IN_NEW_LINE_FOR_NAMESPACES,
+    OMIT_COMMENT_AFTER_END_BRACE_TYPES,
+    OMIT_COMMENT_AFTER_END_BRACE_NAMESPACES
+)
 
-def _get_option_value(options, field):
-    if 'cpp' in options.extras and field in options.extras['cpp']:
-        return options.extras['cpp'][field]
-    else:
-        return field.default
+
+class ResolvedOptions(object):
+    """Immutable snapshot of the C++ options in options.extras['cpp'], with
+    the defaults applied for the fields not given. If strict is set, a
+    ValueError is raised for unknown keys."""
+
+    __slots__ = ('_values',)
+
+    def __init__(self, options, strict=False):
+        extras = options.extras.get('cpp', {})
+        if strict:
+            unknown = [key for key in extras if key not in _FIELDS]
+            if unknown:
+                raise ValueError(
+                    'Unknown C++ options: {0}.'.format(unknown))
+        values = tuple(extras[field] if field in extras else field.default
+                       for field in _FIELDS)
+        object.__setattr__(self, '_values', values)
+
+    def __getitem__(self, field):
+        return self._values[field.id]
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Resolved options are immutable.')
+
+
+def resolve_options(options, strict=False):
+    """Returns the resolved C++ options."""
+    return ResolvedOptions(options, strict)
+
+
+def _resolved_options(context):
+    # Resolved once for each serialization.
+    return context.resolved('cpp', ResolvedOptions)
+
+
+def _field(name):
+    """Property for a field of a tag caching strings built from its fields.
+    Setting it clears the cached strings."""
+    attribute = '_' + name
+
+    def get(self):
+        return getattr(self, attribute)
+
+    def set(self, value):
+        self._check_not_frozen()
+        setattr(self, attribute, value)
+        self._invalidate()
+
+    return property(get, set)
 
 
 class CppFile(scope.TagBase):
+    __slots__ = ()
+
     def serialize(self, context):
         for child in self.children:
             context.serialize(child)
 
 
 class CppNamespace(scope.TagBase):
+    __slots__ = ('_name',)
+
     def __init__(self, name = None):
         super(CppNamespace, self).__init__()
-        self._name = name
+        self._name = scope.intern(name)
 
     def serialize(self, context):
         declaration = 'namespace'
         if self._name is not None:
             declaration += ' {0}'.format(self._name)
 
-        brace_in_new_line = _get_option_value(context.options,
-            OPEN_BRACE_IN_NEW_LINE_FOR_NAMESPACES)
+        brace_in_new_line = _resolved_options(context)[
+            OPEN_BRACE_IN_NEW_LINE_FOR_NAMESPACES]
 
         if brace_in_new_line:
             context.write(declaration)
@@ -81,8 +148,8 @@ class CppNamespace(scope.TagBase):
             context.serialize(child)
         context.unindent()
 
-        omit_comment = _get_option_value(context.options,
-            OMIT_COMMENT_AFTER_END_BRACE_NAMESPACES)
+        omit_comment = _resolved_options(context)[
+            OMIT_COMMENT_AFTER_END_BRACE_NAMESPACES]
 
         if omit_comment:
             context.write('}')
@@ -97,25 +164,28 @@ class CppNamespace(scope.TagBase):
 
 
 class CppClassBase(scope.TagBase):
+    __slots__ = ('_unit_name', '_default_visibility', '_name', '_visibility',
+                 '_superclasses', '_header')
+
+    # The declaration and the header, built once from the fields.
+    TRANSIENT_ATTRIBUTES = scope.TagBase.TRANSIENT_ATTRIBUTES | \
+        frozenset(['_header'])
+
     def __init__(self, unit_name, default_visibility, name, superclasses,
                  visibility):
         super(CppClassBase, self).__init__()
         self._unit_name = unit_name
         self._default_visibility = default_visibility
-        self._name = name
+        self._name = scope.intern(name)
         self._visibility = visibility
-        self._superclasses = superclasses
+        self._superclasses = scope.intern(superclasses)
+        self._header = None
 
     def serialize(self, context):
-        declaration = '{0} {1}'.format(self._unit_name, self._name)
+        declaration, temp = self._header or self._build_header()
 
-        temp = declaration
-        if len(self._superclasses) > 0:
-            f = lambda v, n: '{0} {1}'.format(_from_visibility_to_string(v), n)
-            temp += ' : ' + ', '.join([f(v, n) for v, n in self._superclasses])
-
-        brace_in_new_line = _get_option_value(context.options,
-            OPEN_BRACE_IN_NEW_LINE_FOR_TYPES)
+        brace_in_new_line = _resolved_options(context)[
+            OPEN_BRACE_IN_NEW_LINE_FOR_TYPES]
 
         if brace_in_new_line:
             context.write(temp)
@@ -123,84 +193,93 @@ class CppClassBase(scope.TagBase):
         else:
             context.write(temp + ' {')
 
+        sections = _partition_by_visibility(context, self.children,
+                                            self._default_visibility)
+
         if self._default_visibility == PRIVATE:
-            self._print_children(context, PRIVATE)
-            self._print_children(context, PUBLIC, 'public:')
+            self._print_section(context, sections[PRIVATE])
+            self._print_section(context, sections[PUBLIC], 'public:')
         elif self._default_visibility == PUBLIC:
-            self._print_children(context, PUBLIC)
-            self._print_children(context, PRIVATE, 'private:')
+            self._print_section(context, sections[PUBLIC])
+            self._print_section(context, sections[PRIVATE], 'private:')
 
-        self._print_children(context, PROTECTED, 'protected:')
+        self._print_section(context, sections[PROTECTED], 'protected:')
 
-        omit_comment = _get_option_value(context.options,
-            OMIT_COMMENT_AFTER_END_BRACE_TYPES)
+        omit_comment = _resolved_options(context)[
+            OMIT_COMMENT_AFTER_END_BRACE_TYPES]
 
         if omit_comment:
             context.write('};')
         else:
             context.write('}; // ' + declaration)
 
-    def _print_children(self, context, visibility, section_name = None):
-        selected = _filter_by_visibility(self.children,
-            visibility, self._default_visibility)
-        if len(selected) > 0:
-            if section_name is not None:
-                context.write(section_name)
-            _indent_and_print_elements(context, selected)
+    def _build_header(self):
+        declaration = '{0} {1}'.format(self._unit_name, self._name)
 
-    @property
-    def name(self):
-        return self._name
+        temp = declaration
+        if len(self._superclasses) > 0:
+            f = lambda v, n: '{0} {1}'.format(_from_visibility_to_string(v), n)
+            temp += ' : ' + ', '.join([f(v, n) for v, n in self._superclasses])
 
-    @property
-    def visibility(self):
-        return self._visibility
+        self._header = (declaration, temp)
+        return self._header
 
-    @property
-    def superclasses(self):
-        return self._superclasses
+    def _invalidate(self):
+        self._header = None
+        self._hash = None
+
+    def _print_section(self, context, elements, section_name = None):
+        if len(elements) > 0:
+            if section_name is not None:
+                context.write(section_name)
+            _indent_and_print_elements(context, elements)
+
+    name = _field('name')
+    visibility = _field('visibility')
+    superclasses = _field('superclasses')
 
 
 class CppClass(CppClassBase):
+    __slots__ = ()
+
     def __init__(self, name, superclasses = [], visibility = DEFAULT):
         super(CppClass, self).__init__('class', PRIVATE, name, superclasses,
                                        visibility)
 
 
 class CppStruct(CppClassBase):
+    __slots__ = ()
+
     def __init__(self, name, superclasses = [], visibility = DEFAULT):
         super(CppStruct, self).__init__('struct', PUBLIC, name, superclasses,
                                         visibility)
 
 
 class CppMethodBase(scope.TagBase):
+    __slots__ = ('_return_type', '_name', '_visibility', '_virtual',
+                 '_arguments', '_const', '_initialize', '_signature')
+
+    # The signature and the initializations, built once from the fields.
+    TRANSIENT_ATTRIBUTES = scope.TagBase.TRANSIENT_ATTRIBUTES | \
+        frozenset(['_signature'])
+
     def __init__(self, return_type, name, arguments=[], initialize=[],
                  visibility=DEFAULT, virtual=False, const=False):
         super(CppMethodBase, self).__init__()
-        self._return_type = return_type
-        self._name = name
+        self._return_type = scope.intern(return_type)
+        self._name = scope.intern(name)
         self._visibility = visibility
         self._virtual = virtual
-        self._arguments = arguments
+        self._arguments = scope.intern(arguments)
         self._const = const
-        self._initialize = initialize
+        self._initialize = scope.intern(initialize)
+        self._signature = None
 
     def serialize(self, context):
-        temp = ''
-        if self._virtual: temp += 'virtual '
+        temp, initializations = self._signature or self._build_signature()
 
-        args = ', '.join(self._arguments)
-        if self._return_type is not None: temp += self._return_type + ' '
-        temp += '{1}({2})'.format(self._return_type, self._name, args)
-
-        if self._const: temp += ' const'
-
-        brace_in_new_line = _get_option_value(context.options,
-            OPEN_BRACE_IN_NEW_LINE_FOR_METHODS)
-
-        initializations = ''
-        if len(self._initialize) > 0:
-            initializations = ' : ' + ', '.join(self._initialize)
+        brace_in_new_line = _resolved_options(context)[
+            OPEN_BRACE_IN_NEW_LINE_FOR_METHODS]
 
         if len(self.children) > 0:
             temp += initializations
@@ -217,36 +296,39 @@ class CppMethodBase(scope.TagBase):
         else:
             context.write(temp + ';')
 
-    @property
-    def return_type(self):
-        return self._return_type
+    def _build_signature(self):
+        temp = ''
+        if self._virtual: temp += 'virtual '
 
-    @property
-    def name(self):
-        return self._name
+        args = ', '.join(self._arguments)
+        if self._return_type is not None: temp += self._return_type + ' '
+        temp += '{1}({2})'.format(self._return_type, self._name, args)
 
-    @property
-    def arguments(self):
-        return self._arguments
+        if self._const: temp += ' const'
 
-    @property
-    def virtual(self):
-        return self._virtual
+        initializations = ''
+        if len(self._initialize) > 0:
+            initializations = ' : ' + ', '.join(self._initialize)
 
-    @property
-    def const(self):
-        return self._const
+        self._signature = (temp, initializations)
+        return self._signature
 
-    @property
-    def visibility(self):
-        return self._visibility
-    
-    @property
-    def initialize(self):
-        return self._initialize
+    def _invalidate(self):
+        self._signature = None
+        self._hash = None
+
+    return_type = _field('return_type')
+    name = _field('name')
+    arguments = _field('arguments')
+    virtual = _field('virtual')
+    const = _field('const')
+    visibility = _field('visibility')
+    initialize = _field('initialize')
 
 
 class CppMethod(CppMethodBase):
+    __slots__ = ()
+
     def __init__(self, return_type, name, arguments = [],
                  visibility = DEFAULT, virtual = False, const = False):
         super(CppMethod, self).__init__(
@@ -258,6 +340,8 @@ class CppMethod(CppMethodBase):
 
 
 class CppConstructor(CppMethodBase):
+    __slots__ = ()
+
     def __init__(self, name, arguments=[], initialize=[], visibility=DEFAULT):
         super(CppConstructor, self).__init__(
             None, name, arguments,
@@ -267,6 +351,8 @@ class CppConstructor(CppMethodBase):
 
 
 class CppDestructor(CppMethodBase):
+    __slots__ = ()
+
     def __init__(self, name, visibility = DEFAULT, virtual = False):
         super(CppDestructor, self).__init__(
             None, name, [],
@@ -276,17 +362,28 @@ class CppDestructor(CppMethodBase):
 
 
 class CppAttribute(scope.TagBase):
+    __slots__ = ('_type', '_name', '_visibility', '_static', '_const',
+                 '_default_value', '_line')
+
+    # The declaration, built once from the fields.
+    TRANSIENT_ATTRIBUTES = scope.TagBase.TRANSIENT_ATTRIBUTES | \
+        frozenset(['_line'])
+
     def __init__(self, type, name, visibility = DEFAULT, static = False,
                  const = False, default_value = None):
         super(CppAttribute, self).__init__()
-        self._type = type
-        self._name = name
+        self._type = scope.intern(type)
+        self._name = scope.intern(name)
         self._visibility = visibility
         self._static = static
         self._const = const
-        self._default_value = default_value
+        self._default_value = scope.intern(default_value)
+        self._line = None
 
     def serialize(self, context):
+        context.write(self._line or self._build_line())
+
+    def _build_line(self):
         line = ''
         if self._static:
             line += 'static '
@@ -297,38 +394,28 @@ class CppAttribute(scope.TagBase):
             line += ' = {0}'.format(self._default_value)
         line += ';'
 
-        context.write(line)
-
-    @property
-    def type(self):
-        return self._type
-
-    @property
-    def name(self):
-        return self._name
-
-    @property
-    def visibility(self):
-        return self._visibility
-
-    @property
-    def static(self):
-        return self._static
+        self._line = line
+        return line
 
-    @property
-    def const(self):
-        return self._const
+    def _invalidate(self):
+        self._line = None
+        self._hash = None
 
-    @property
-    def default_value(self):
-        return self._default_value
+    type = _field('type')
+    name = _field('name')
+    visibility = _field('visibility')
+    static = _field('static')
+    const = _field('const')
+    default_value = _field('default_value')
 
 
 class CppEnum(scope.TagBase):
+    __slots__ = ('_name', '_values', '_visibility')
+
     def __init__(self, name, values, visibility = PUBLIC):
         super(CppEnum, self).__init__()
-        self._name = name
-        self._values = values
+        self._name = scope.intern(name)
+        self._values = scope.intern(values)
         self._visibility = visibility
 
     def serialize(self, context):
@@ -367,15 +454,29 @@ def _from_visibility_to_string(visibility):
         raise ValueError('Invalid value for visibility.')
 
 
-def _filter_by_visibility(children, visibility, default_visibility):
-    if default_visibility == visibility:
-        return [child
-                for child in children
-                if child.visibility in [visibility, DEFAULT]]
-    else:
-        return [child
-                for child in children
-                if child.visibility == visibility]
+def _partition_by_visibility(context, children, default_visibility):
+    """Splits the children of a type by visibility in a single pass, keeping
+    their order. Children with DEFAULT visibility, and children which are not
+    members (strings, new lines or other tags without a visibility), belong
+    to the default visibility of the type. Lazy for_each blocks are expanded,
+    so their members are placed by their own visibility."""
+    sections = {PRIVATE: [], PUBLIC: [], PROTECTED: []}
+    stack = [iter(children)]
+    while stack:
+        for child in stack[-1]:
+            if isinstance(child, scope.LazyForEachTag):
+                stack.append(child.expand(context))
+                break
+            visibility = getattr(child, 'visibility', DEFAULT)
+            if visibility is DEFAULT:
+                visibility = default_visibility
+            try:
+                sections[visibility].append(child)
+            except KeyError:
+                raise ValueError('Invalid value for visibility.')
+        else:
+            stack.pop()
+    return sections
 
 
 def _indent_and_print_elements(context, elements):
@@ -8,10 +8,27 @@
 # pylint: disable=C0111
 
 import unittest
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None  # pylint: disable-msg=C0103
+
 from .. import scope
+from ..test_scope import ListSink
 from . import cpp
 
 
+def _record_template(record):
+    name, attr_type = record
+    return cpp.tclass(name)[
+        cpp.tattribute(attr_type, '_value'),
+        cpp.tmethod(attr_type, 'GetValue', visibility=cpp.PUBLIC)[
+            'return _value;'
+        ]
+    ]
+
+
 class TestCppSerializer(unittest.TestCase):  # pylint: disable-msg=R0904
     def test_cpp_serializer_1(self):
         template = cpp.tfile[
@@ -457,6 +474,62 @@ public:
 
         self.assertEqual(scope.serialize(template), expected)
 
+    def test_cpp_serializer_28(self):
+        template = cpp.tfile[
+            scope.new_line,
+            cpp.tclass('A')[
+                cpp.tmethod('void', 'a', visibility=cpp.PUBLIC),
+                '// comment',
+                cpp.tattribute('int', '_b', visibility=cpp.PROTECTED),
+                scope.new_line,
+                cpp.tmethod('void', 'c', visibility=cpp.PUBLIC),
+                cpp.tattribute('int', '_d')
+            ]
+        ]
+
+        expected = """
+class A {
+    // comment
+
+    int _d;
+public:
+    void a();
+    void c();
+protected:
+    int _b;
+}; // class A
+"""
+
+        self.assertEqual(scope.serialize(template), expected)
+
+    def test_cpp_serializer_29(self):
+        template = cpp.tfile[
+            cpp.tstruct('A')[
+                cpp.tattribute('int', '_a', visibility=cpp.PRIVATE),
+                scope.for_each(range(0, 2),
+                               lambda n: 'int b{0};'.format(n), lazy=True)
+            ]
+        ]
+
+        expected = """struct A {
+    int b0;
+    int b1;
+private:
+    int _a;
+}; // struct A
+"""
+
+        self.assertEqual(scope.serialize(template), expected)
+
+    def test_cpp_serializer_30(self):
+        template = cpp.tfile[
+            cpp.tclass('A')[
+                cpp.tattribute('int', '_a', visibility=None)
+            ]
+        ]
+
+        self.assertRaises(ValueError, scope.serialize, template)
+
     def test_example_1(self):
         expected = cpp.tfile [
             '#include <string>',
@@ -502,6 +575,324 @@ public:
 
         self.assertEqual(scope.flatten(template), scope.flatten(expected))
 
+    def test_resolved_options_1(self):
+        options = scope.SerializerOptions()
+        resolved = cpp.resolve_options(options)
+        self.assertFalse(resolved[cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES])
+
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True
+        }
+        resolved = cpp.resolve_options(options, strict=True)
+        self.assertTrue(resolved[cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES])
+        self.assertFalse(resolved[cpp.OPEN_BRACE_IN_NEW_LINE_FOR_METHODS])
+
+        def modify():
+            resolved._values = ()
+        self.assertRaises(AttributeError, modify)
+
+    def test_resolved_options_2(self):
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            'open_brace': True
+        }
+
+        cpp.resolve_options(options)
+        self.assertRaises(ValueError, cpp.resolve_options, options,
+                          strict=True)
+
+    def test_resolved_options_3(self):
+        options = scope.SerializerOptions()
+        context = scope.SerializerContext(options)
+        resolved = cpp._resolved_options(context)
+
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True
+        }
+        self.assertTrue(cpp._resolved_options(context) is resolved)
+
+    def test_compiled_template_1(self):
+        def accessor(class_name, attr_type, attr_name, camel_name='Value'):
+            return cpp.tclass(class_name)[
+                cpp.tattribute(attr_type, attr_name),
+                cpp.tmethod(attr_type, 'Get' + camel_name,
+                            visibility=cpp.PUBLIC, const=True)[
+                    'return this->{0};'.format(attr_name)
+                ],
+                cpp.tmethod('void', 'Set{0}'.format(camel_name),
+                            ['const {0} & value'.format(attr_type)],
+                            visibility=cpp.PUBLIC)[
+                    'this->{0} = value;'.format(attr_name)
+                ]
+            ]
+
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_METHODS: True
+        }
+        compiled = scope.compile(accessor, options)
+
+        self.assertEqual(compiled.names,
+                         ('class_name', 'attr_type', 'attr_name',
+                          'camel_name'))
+        self.assertEqual(
+            compiled.render('App', 'std::string', '_name', 'Name'),
+            scope.serialize(accessor('App', 'std::string', '_name', 'Name'),
+                            options))
+        self.assertEqual(
+            compiled.render('A', attr_name='_b', attr_type='int'),
+            scope.serialize(accessor('A', 'int', '_b'), options))
+
+        self.assertRaises(TypeError, compiled.render, 'A')
+        self.assertRaises(TypeError, compiled.render, 'A', 'int', '_b',
+                          foo=1)
+        self.assertRaises(TypeError, compiled.render, 1, 2, 3, 4, 5)
+
+    def test_compiled_template_2(self):
+        def bad(name):
+            return cpp.tclass(name[:2])
+
+        self.assertRaises(ValueError, scope.compile, bad)
+        self.assertRaises(TypeError, scope.compile, lambda * args: 'a')
+
+    def test_compiled_template_3(self):
+        def transformed(method):
+            return lambda name: cpp.tclass(getattr(name, method)())
+
+        for method in ['capitalize', 'upper', 'lower', 'strip']:
+            self.assertRaises(ValueError, scope.compile, transformed(method))
+
+    def test_fused_serialization_1(self):
+        shared = cpp.tmethod('void', 'Shared')['return;']
+        template = cpp.tfile[
+            self._parallel_template(),
+            cpp.tclass('A')[shared, shared]
+        ]
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True
+        }
+
+        expected = scope.serialize(template, options)
+        collector = scope.TimingCollector()
+
+        self.assertEqual(scope.serialize(template, options, fused=True,
+                                         hooks=[collector]),
+                         expected)
+        self.assertEqual(collector.statistics[cpp.CppMethod].count, 22)
+
+        sink = ListSink()
+        scope.serialize_to(template, sink, options, fused=True)
+        self.assertEqual(sink.getvalue(), expected)
+
+        self.assertRaises(ValueError, scope.serialize, template, fused=True,
+                          cache=scope.RenderCache())
+
+    def test_fused_serialization_2(self):
+        template = cpp.tnamespace('n')[
+            cpp.tclass('A')[cpp.tattribute('int', 'x')],
+            'int y;'
+        ]
+        flattened = scope.flatten(template)
+        expected = scope.serialize(flattened)
+
+        self.assertEqual(scope.serialize(template, fused=True), expected)
+        self.assertEqual(scope.serialize(flattened), expected)
+        self.assertEqual(len(flattened.children), 2)
+        self.assertEqual(scope.serialize(template, fused=True), expected)
+
+    def test_fused_serialization_3(self):
+        class TwiceTag(scope.TagBase):
+            def serialize(self, context):
+                for child in self.children:
+                    context.serialize(child)
+                    context.serialize(child)
+
+        template = scope.Tag(TwiceTag)[
+            cpp.tclass('A')[cpp.tattribute('int', 'x')]
+        ]
+        expected = scope.serialize(template)
+
+        self.assertEqual(expected.count('int x;'), 2)
+        self.assertEqual(scope.serialize(template, fused=True), expected)
+
+    @unittest.skipIf(concurrent is None, 'concurrent.futures is missing.')
+    def test_batch_serialization_1(self):
+        records = [('A{0}'.format(n), 'int') for n in range(0, 25)]
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True
+        }
+        expected = [scope.serialize(_record_template(record), options)
+                    for record in records]
+
+        self.assertEqual(
+            scope.serialize_batch(_record_template, records, options),
+            expected)
+
+        self.assertEqual(
+            scope.serialize_batch(_record_template, iter(records), options,
+                                  workers=2, chunk_size=4),
+            expected)
+
+        with concurrent.futures.ThreadPoolExecutor(3) as executor:
+            sink = ListSink()
+            scope.serialize_batch(_record_template, iter(records), options,
+                                  sink=sink, executor=executor, chunk_size=3)
+            self.assertEqual(sink.getvalue(), ''.join(expected))
+
+        sink = ListSink()
+        scope.serialize_batch(_record_template, records, options, sink=sink)
+        self.assertEqual(sink.getvalue(), ''.join(expected))
+
+    def test_compact_representation_1(self):
+        import pickle
+
+        template = scope.flatten(cpp.tfile[
+            cpp.tclass('A', superclasses=[(cpp.PUBLIC, 'B')])[
+                cpp.tattribute('int', '_a'),
+                cpp.tmethod('int', 'foo', ['int a'], visibility=cpp.PUBLIC)[
+                    'return a;'
+                ]
+            ]
+        ])
+
+        for element in [template, template.children[0],
+                        template.children[0].children[0]]:
+            self.assertFalse(hasattr(element, '__dict__'))
+        self.assertEqual(template.children[0].children[0].children, [])
+
+        for protocol in range(0, pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(template, protocol))
+            self.assertEqual(copy, template)
+            self.assertEqual(scope.serialize(copy),
+                             scope.serialize(template))
+
+    def test_intern_table_1(self):
+        def new(value):
+            # Equal strings, but not the same instance.
+            return ''.join(list(value))
+
+        def template(n):
+            return cpp.tclass('A{0}'.format(n),
+                              superclasses=[(cpp.PUBLIC, new('Base'))])[
+                cpp.tattribute(new('std::string'), new('_a')),
+                cpp.tmethod(new('void'), 'Set',
+                            [new('const std::string & value')])
+            ]
+
+        with scope.InternTable():
+            first = scope.flatten(template(1))
+            second = scope.flatten(template(2))
+
+        for attribute in ['_type', '_name']:
+            self.assertTrue(getattr(first.children[0], attribute) is
+                            getattr(second.children[0], attribute))
+        self.assertTrue(first.children[1]._return_type is
+                        second.children[1]._return_type)
+        self.assertTrue(first.children[1]._arguments[0] is
+                        second.children[1]._arguments[0])
+        self.assertTrue(first._superclasses[0][1] is
+                        second._superclasses[0][1])
+        self.assertEqual(scope.serialize(first).replace('A1', 'A2'),
+                         scope.serialize(second))
+
+    def test_cached_signatures_1(self):
+        import pickle
+
+        template = scope.flatten(cpp.tfile[
+            cpp.tclass('A', superclasses=[(cpp.PUBLIC, 'B')])[
+                cpp.tattribute('int', '_a'),
+                cpp.tmethod('int', 'foo', ['int a'], visibility=cpp.PUBLIC)[
+                    'return a;'
+                ]
+            ]
+        ])
+        copy = pickle.loads(pickle.dumps(template))
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True,
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_METHODS: True
+        }
+
+        output = scope.serialize(template)
+        self.assertEqual(scope.serialize(template), output)
+        self.assertEqual(scope.serialize(template, options),
+                         scope.serialize(copy, options))
+        self.assertEqual(template, copy)
+        self.assertEqual(hash(template), hash(copy))
+
+        klass = template.children[0]
+        attribute, method = klass.children
+        self.assertEqual(pickle.loads(pickle.dumps(method)), method)
+
+        klass.name = 'C'
+        klass.superclasses = []
+        attribute.static = True
+        method.arguments = ['int a', 'int b']
+        self.assertNotEqual(template, copy)
+        self.assertEqual(scope.serialize(template), '''\
+class C {
+    static int _a;
+public:
+    int foo(int a, int b) {
+        return a;
+    }
+}; // class C
+''')
+
+    def test_cached_signatures_2(self):
+        frozen = scope.freeze(cpp.tmethod('void', 'foo'))
+
+        def modify():
+            frozen.name = 'bar'
+
+        self.assertRaises(RuntimeError, modify)
+        self.assertEqual(frozen.name, 'foo')
+
+    def test_serialize_variants_1(self):
+        template = cpp.tfile[
+            cpp.tnamespace('n')[
+                cpp.tclass('A')[
+                    cpp.tmethod('int', 'foo', visibility=cpp.PUBLIC)[
+                        'return 0;'
+                    ]
+                ]
+            ]
+        ]
+        variants = []
+        for brace in [False, True]:
+            for tab_size in [None, 4]:
+                options = scope.SerializerOptions()
+                options.tab_size = tab_size
+                options.extras['cpp'] = {
+                    cpp.OPEN_BRACE_IN_NEW_LINE_FOR_METHODS: brace,
+                    cpp.OMIT_COMMENT_AFTER_END_BRACE_TYPES: brace
+                }
+                variants.append(options)
+
+        outputs = scope.serialize_variants(template, variants)
+
+        self.assertEqual(outputs, [scope.serialize(template, options)
+                                   for options in variants])
+        self.assertEqual(len(set(outputs)), 4)
+
+    def test_lazy_members_1(self):
+        def template(lazy):
+            return cpp.tclass('A')[
+                cpp.tattribute('int', 'x'),
+                scope.for_each(['f', 'g'], lambda n: cpp.tmethod(
+                    'void', n, visibility=cpp.PUBLIC
+                ), lazy=lazy)
+            ]
+
+        expected = scope.serialize(template(False))
+
+        self.assertTrue('public:' in expected)
+        self.assertEqual(scope.serialize(template(True)), expected)
+        self.assertEqual(scope.serialize(template(True), fused=True),
+                         expected)
+
     def test_custom_serialization_1(self):
         template = cpp.tfile[
             scope.new_line,
@@ -627,5 +1018,95 @@ void foo()
         self.assertEqual(scope.serialize(template, options), expected)
 
 
+    def _parallel_template(self):
+        return cpp.tfile[
+            '#include <string>',
+            scope.new_line,
+            cpp.tnamespace('A')[
+                scope.for_each(range(0, 20), lambda n: cpp.tclass(
+                    'Foo{0}'.format(n),
+                    superclasses=[(cpp.PUBLIC, 'Bar')]
+                )[
+                    cpp.tattribute('int', '_a'),
+                    cpp.tmethod('int', 'GetA', visibility=cpp.PUBLIC)[
+                        'return _a;'
+                    ]
+                ])
+            ],
+            scope.for_each(range(0, 20), lambda n: cpp.tstruct(
+                'Baz{0}'.format(n)
+            ))
+        ]
+
+    @unittest.skipIf(concurrent is None, 'concurrent.futures is missing.')
+    def test_parallel_serialization_1(self):
+
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_TYPES: True
+        }
+
+        expected = scope.serialize(self._parallel_template(), options)
+
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            output = scope.serialize(self._parallel_template(), options,
+                                     executor=executor)
+
+        self.assertEqual(output, expected)
+
+    @unittest.skipIf(concurrent is None, 'concurrent.futures is missing.')
+    def test_parallel_serialization_2(self):
+        options = scope.SerializerOptions()
+        options.extras['cpp'] = {
+            cpp.OPEN_BRACE_IN_NEW_LINE_FOR_METHODS: True
+        }
+
+        templates = [self._parallel_template(), cpp.tfile[cpp.tclass('A')]]
+        expected = [scope.serialize(template, options)
+                    for template in templates]
+
+        self.assertEqual(scope.serialize_many(templates, options, workers=2),
+                         expected)
+        self.assertEqual(scope.serialize(templates[0], options, workers=2),
+                         expected[0])
+
+
+    def test_incremental_serialization_1(self):
+        def template(changed):
+            return cpp.tfile[
+                '#include <string>',
+                cpp.tnamespace('A')[
+                    scope.for_each(range(0, 50), lambda n: cpp.tclass(
+                        'Foo{0}'.format(n)
+                    )[
+                        cpp.tattribute('int', '_a'),
+                        cpp.tmethod('int', 'GetA', visibility=cpp.PUBLIC)[
+                            'return _a + {0};'.format(
+                                1 if n == changed else 0)
+                        ]
+                    ])
+                ]
+            ]
+
+        serializer = scope.IncrementalSerializer()
+
+        self.assertEqual(serializer.serialize(template(None)),
+                         scope.serialize(template(None)))
+
+        # Only the file, the namespace, the class and the method changed.
+        self.assertEqual(serializer.serialize(template(10)),
+                         scope.serialize(template(10)))
+        self.assertEqual(serializer.rendered, 4)
+        self.assertEqual(serializer.reused, 49 + 1)
+
+        # Both methods are reused from other classes, by structure.
+        self.assertEqual(serializer.serialize(template(20)),
+                         scope.serialize(template(20)))
+        self.assertEqual(serializer.rendered, 4)
+
+        self.assertEqual(serializer.serialize(template(None)),
+                         scope.serialize(template(None)))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,23 @@
 
 """Library for code template serialization."""
 
+import collections
+import errno
+import inspect
 import itertools
+import operator
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # pylint: disable-msg=F0401
 
 
 class SerializerOptions(object):
@@ -21,6 +37,9 @@ class SerializerOptions(object):
             SerializerOptions.DEFAULT_INDENTATION_CHARACTER
         self._indentation_factor = \
             SerializerOptions.DEFAULT_INDENTATION_FACTOR
+        self._tab_size = None
+        self._max_indentation_level = None
+        self._intern_table = None
         self._extras = {}
 
     @property
@@ -43,52 +62,422 @@ class SerializerOptions(object):
         """Set the factor of characters used for indentation"""
         self._indentation_factor = value
 
+    @property
+    def tab_size(self):
+        """If set, and the indentation character is a space, each group of
+        this number of spaces in the indentation is replaced by a tab."""
+        return self._tab_size
+
+    @tab_size.setter
+    def tab_size(self, value):
+        """Set the number of spaces replaced by a tab."""
+        self._tab_size = value
+
+    @property
+    def max_indentation_level(self):
+        """Maximum number of nested indent operations, or None if there is no
+        limit."""
+        return self._max_indentation_level
+
+    @max_indentation_level.setter
+    def max_indentation_level(self, value):
+        """Set the maximum number of nested indent operations."""
+        self._max_indentation_level = value
+
+    @property
+    def intern_table(self):
+        """InternTable active while the template is flattened and serialized,
+        or None."""
+        return self._intern_table
+
+    @intern_table.setter
+    def intern_table(self, value):
+        """Set the table used for interning strings."""
+        self._intern_table = value
+
     @property
     def extras(self):
         return self._extras
 
 
-class SerializerContext(object):
-    """Context object for the output generator."""
+class InternTable(object):
+    """Table of canonical instances of strings. While a table is active,
+    in a with statement, the strings of the flattened templates and of the
+    attributes given to the tags supporting it are replaced by the instance
+    in the table, so equal strings are stored once and compared by identity.
+    The table keeps its strings until it is cleared.
 
-    def __init__(self, options):
-        self._output = ''
-        self._indentation = 0
+    Tables are active in the thread where they are entered. Their content
+    is not pickled."""
+
+    def __init__(self):
+        self._values = {}
+
+    def __enter__(self):
+        tables = getattr(_INTERN_TABLES, 'stack', None)
+        if tables is None:
+            tables = _INTERN_TABLES.stack = []
+        tables.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _INTERN_TABLES.stack.pop()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, value):
+        return value in self._values
+
+    def __getstate__(self):
+        # The state must not be empty, or Python 2 doesn't call __setstate__.
+        return {'_values': {}}
+
+    def __setstate__(self, state):
+        self._values = {}
+
+    def intern(self, value):
+        """Returns the canonical instance of a string. Lists and tuples are
+        copied with their strings interned, and tuples of strings are also
+        shared. Other values are returned as they are."""
+        if value.__class__ is str:
+            return self._values.setdefault(value, value)
+        elif value.__class__ is list:
+            return [self.intern(item) for item in value]
+        elif value.__class__ is tuple:
+            value = tuple(self.intern(item) for item in value)
+            if all(item.__class__ is str for item in value):
+                return self._values.setdefault(value, value)
+        return value
+
+    def clear(self):
+        """Removes all the strings."""
+        self._values.clear()
+
+
+# Stacks of active intern tables, by thread.
+_INTERN_TABLES = threading.local()
+
+
+def _active_intern_table():
+    """Returns the intern table active in the current thread, or None."""
+    tables = getattr(_INTERN_TABLES, 'stack', None)
+    return tables[-1] if tables else None
+
+
+def intern(value):  # pylint: disable-msg=W0622
+    """Returns the value interned in the active InternTable, or the value
+    itself if no table is active. See InternTable.intern."""
+    table = _active_intern_table()
+    if table is None:
+        return value
+    return table.intern(value)
+
+
+class RenderCache(object):
+    """Least recently used cache for the output of serialized elements. It
+    can be shared between serializations for reusing the output of elements
+    which appear several times."""
+
+    def __init__(self, maxsize=1024, structural=False):
+        self._maxsize = maxsize
+        self._structural = structural
+        self._entries = collections.OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """Returns the output stored for the key, or None if not present."""
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self._misses += 1
+            return None
+        self._entries[key] = value
+        self._hits += 1
+        return value
+
+    def put(self, key, value):
+        """Stores the output for the key, evicting the least recently used
+        entries if needed."""
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all entries and resets the statistics."""
+        self._entries.clear()
+        self._hits = 0
+        self._misses = 0
+
+    def key(self, tag, options_key, level):
+        """Key for the output of an element. Elements are identified by
+        identity, or by structure if the cache is structural, so equal
+        elements share their output. In both cases, they must not be modified
+        while the cache is used.
+
+        The elements created from the tags are new for each serialization
+        using a cache, so by identity, only the output of the elements found
+        several times in the templates, frozen or flattened before, is
+        reused."""
+        if self._structural:
+            return (tag, options_key, level)
+        return (id(tag), options_key, level)
+
+    @property
+    def hits(self):
+        """Number of lookups which found the output."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """Number of lookups which didn't find the output."""
+        return self._misses
+
+    @property
+    def currsize(self):
+        """Number of entries in the cache."""
+        return len(self._entries)
+
+    @property
+    def maxsize(self):
+        """Maximum number of entries in the cache."""
+        return self._maxsize
+
+
+class SerializerContext(object):
+    """Context object for the output generator. If a sink is provided, the
+    output is written to it incrementally instead of being kept in memory.
+    If a render cache is provided, the output of the elements is taken from
+    it when available. With a sink, only elements whose output stays below
+    the flush threshold are stored in the cache; the output of larger ones is
+    sent to the sink as usual. Hooks, if provided, are called before and
+    after the serialization of each element."""
+
+    # Number of buffered chunks after which the output is sent to the sink.
+    FLUSH_THRESHOLD = 1024
+
+    def __init__(self, options, sink=None, cache=None, hooks=None):
+        self._chunks = []
         self._options = options
+        self._indentation_factor = options.indentation_factor
+        self._max_level = options.max_indentation_level
+        self._prefixes = [_indentation_prefix(options, 0)]
+        if self._max_level is not None:
+            self._prefixes.extend(_indentation_prefix(options, level)
+                                  for level in range(1, self._max_level + 1))
+        self._level = 0
+        self._prefix = ''
+        self._sink = sink
+        if sink is None:
+            self._flush_threshold = sys.maxsize
+        else:
+            self._flush_threshold = SerializerContext.FLUSH_THRESHOLD
+        self._cache = cache
+        self._options_key = None
+        # Number of elements being captured for the cache, and the number of
+        # times the captures were abandoned because the output had to be
+        # flushed.
+        self._captures = 0
+        self._abandoned = 0
+        self._resolved = {}
+        self._hooks = ()
+        self._written = None
+        if hooks:
+            self._install_hooks(hooks)
 
     def write(self, string):
         """Print provided string to the output."""
-        self._output += self._options.indentation_character * \
-            self._indentation + string + '\n'
+        self._chunks.append(self._prefix + string + '\n')
+        if len(self._chunks) >= self._flush_threshold:
+            self.flush()
+
+    def write_block(self, text):
+        """Print each line of a multi-line string to the output."""
+        lines = text.splitlines()
+        if lines:
+            prefix = self._prefix
+            self._chunks.append(prefix + ('\n' + prefix).join(lines) + '\n')
+            if len(self._chunks) >= self._flush_threshold:
+                self.flush()
 
     def new_line(self):
         """Add a new blank line."""
-        self._output += '\n'
+        self._chunks.append('\n')
+        if len(self._chunks) >= self._flush_threshold:
+            self.flush()
+
+    def take_output(self):
+        """Returns the output generated so far and clears it, so the context
+        can be reused for another serialization."""
+        output = ''.join(self._chunks)
+        del self._chunks[:]
+        self._set_level(0)
+        return output
+
+    def flush(self):
+        """Send the buffered output to the sink, if any. The elements being
+        captured for the cache, if any, are not cached."""
+        if self._sink is not None and self._chunks:
+            if self._captures:
+                self._captures = 0
+                self._abandoned += 1
+            self._sink.write(''.join(self._chunks))
+            self._chunks = []
 
     def indent(self):
         """Increase line indentation."""
-        self._indentation += self._options.indentation_factor
+        self._set_level(self._level + 1)
 
     def unindent(self):
         """Decrease line indentation."""
-        self._indentation -= self._options.indentation_factor
+        self._set_level(self._level - 1)
+
+    def _set_level(self, level):
+        """Set the number of indent operations applied."""
+        if level <= 0:
+            self._prefix = ''
+        elif level < len(self._prefixes):
+            self._prefix = self._prefixes[level]
+        elif self._max_level is not None:
+            raise ValueError('Maximum indentation level exceeded.')
+        else:
+            while len(self._prefixes) <= level:
+                self._prefixes.append(_indentation_prefix(
+                    self._options, len(self._prefixes)))
+            self._prefix = self._prefixes[level]
+        self._level = level
 
     def serialize(self, tag):
-        """Serialize tag and print it to the output."""
-        try:
-            tag.serialize(self)
-        except (AttributeError, TypeError):
+        """Serialize tag and print it to the output. Objects without a
+        serialize method are printed as strings."""
+        serializable = _SERIALIZABLE_TYPES.get(tag.__class__)
+        if serializable is None:
+            serializable = _is_serializable(tag.__class__)
+        if not serializable:
             self.write(str(tag))
+        elif self._cache is not None and isinstance(tag, TagBase) and \
+                not isinstance(tag, LazyForEachTag):
+            self._serialize_cached(tag)
+        else:
+            tag.serialize(self)
+
+    def _flatten_generated(self, value):
+        """Flattens a value generated during the serialization. The elements
+        are copies if a cache is used, so their identity is not reused."""
+        return _flatten_with(value, self._options, self._cache is not None)
+
+    def _serialize_cached(self, tag):
+        """Serialize an element, using the output in the cache if present."""
+        if self._options_key is None:
+            self._options_key = _freeze(self._options.__dict__)
+        key = self._cache.key(tag, self._options_key, self._level)
+        entry = self._cache.get(key)
+        if entry is not None:
+            self._write_raw(entry[1])
+            return
+        else:
+            start = len(self._chunks)
+            abandoned = self._abandoned
+            self._captures += 1
+            try:
+                tag.serialize(self)
+            finally:
+                if abandoned == self._abandoned:
+                    self._captures -= 1
+            if abandoned != self._abandoned:
+                return
+            output = ''.join(self._chunks[start:])
+            self._chunks[start:] = [output]
+            # The element is kept in the entry, so its identifier isn't
+            # reused while the entry exists.
+            self._cache.put(key, (tag, output))
+            if len(self._chunks) >= self._flush_threshold:
+                self.flush()
+
+    def _write_raw(self, text):
+        """Print text to the output as it is."""
+        self._chunks.append(text)
+        if len(self._chunks) >= self._flush_threshold:
+            self.flush()
+
+    def _install_hooks(self, hooks):
+        """Replace the serialization and output methods of the instance by
+        versions calling the hooks and counting the output, so there is no
+        cost at all if there are no hooks."""
+        self._hooks = tuple(hooks)
+        self._written = 0
+        serialize = self.serialize
+        write = self.write
+        write_block = self.write_block
+        new_line = self.new_line
+        write_raw = self._write_raw
+
+        def serialize_with_hooks(tag):
+            for hook in self._hooks:
+                hook.before_serialize(self, tag)
+            serialize(tag)
+            for hook in reversed(self._hooks):
+                hook.after_serialize(self, tag)
+
+        def counted_write(string):
+            self._written += len(self._prefix) + len(string) + 1
+            write(string)
+
+        def counted_write_block(text):
+            lines = text.splitlines()
+            self._written += sum(len(line) for line in lines) + \
+                len(lines) * (len(self._prefix) + 1)
+            write_block(text)
+
+        def counted_new_line():
+            self._written += 1
+            new_line()
+
+        def counted_write_raw(text):
+            self._written += len(text)
+            write_raw(text)
+
+        self.serialize = serialize_with_hooks
+        self.write = counted_write
+        self.write_block = counted_write_block
+        self.new_line = counted_new_line
+        self._write_raw = counted_write_raw
+
+    def resolved(self, key, factory):
+        """Returns a value derived from the options, such as the options of a
+        language with their defaults applied. It is computed by calling the
+        factory with the options the first time it is requested for the key
+        in this context."""
+        try:
+            return self._resolved[key]
+        except KeyError:
+            value = self._resolved[key] = factory(self._options)
+            return value
+
+    @property
+    def written(self):
+        """Number of characters printed to the output so far. It is only
+        tracked if there are hooks, otherwise it is None."""
+        return self._written
 
     @property
     def indentation(self):
         """Current indentation, in units for the serializer."""
-        return self._indentation
+        return self._level * self._indentation_factor
 
     @property
     def output(self):
-        """Output of the serializer."""
-        return self._output
+        """Output of the serializer. Not available if the output is sent to a
+        sink."""
+        if self._sink is not None:
+            raise RuntimeError('Output was written to the sink.')
+        # The chunks are joined once and kept as a single chunk, so reading
+        # the output repeatedly doesn't copy it again.
+        if len(self._chunks) != 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0]
 
     @property
     def options(self):
@@ -96,18 +485,152 @@ class SerializerContext(object):
         return self._options
 
 
+# Clock used for measuring the serialization.
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class SerializerHooks(object):
+    """Base class for objects observing a serialization. These are called
+    for each element, including strings, before and after it is
+    serialized."""
+
+    def before_serialize(self, context, tag):
+        """Called before serializing an element."""
+        pass
+
+    def after_serialize(self, context, tag):
+        """Called after serializing an element."""
+        pass
+
+
+class TagStatistics(object):
+    """Statistics collected for a tag class."""
+
+    __slots__ = ('count', 'total_time', 'own_time', 'written')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.own_time = 0.0
+        self.written = 0
+
+    def __repr__(self):
+        return ('TagStatistics(count={0}, total_time={1:.6f}, '
+                'own_time={2:.6f}, written={3})').format(
+                    self.count, self.total_time, self.own_time, self.written)
+
+
+class TimingCollector(SerializerHooks):
+    """Hooks aggregating, for each tag class, the number of serialized
+    elements, the time spent in them including and excluding their nested
+    elements, and the number of characters they printed."""
+
+    def __init__(self):
+        self._statistics = {}
+        # Start time, printed characters and time spent in nested elements
+        # of the elements being serialized.
+        self._stack = []
+
+    def before_serialize(self, context, tag):
+        self._stack.append([_clock(), context.written, 0.0])
+
+    def after_serialize(self, context, tag):
+        start, written, nested = self._stack.pop()
+        elapsed = _clock() - start
+        statistics = self._statistics.get(tag.__class__)
+        if statistics is None:
+            statistics = self._statistics[tag.__class__] = TagStatistics()
+        statistics.count += 1
+        statistics.total_time += elapsed
+        statistics.own_time += elapsed - nested
+        statistics.written += context.written - written
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def report(self):
+        """Returns a table with the statistics, sorted by the time spent in
+        the elements excluding their nested elements."""
+        lines = ['{0:<30} {1:>10} {2:>12} {3:>12} {4:>12}'.format(
+            'class', 'count', 'total (s)', 'own (s)', 'written')]
+        for class_, statistics in sorted(self._statistics.items(),
+                                         key=lambda item: -item[1].own_time):
+            lines.append(
+                '{0:<30} {1:>10} {2:>12.6f} {3:>12.6f} {4:>12}'.format(
+                    class_.__name__, statistics.count, statistics.total_time,
+                    statistics.own_time, statistics.written))
+        return '\n'.join(lines)
+
+    @property
+    def statistics(self):
+        """Dictionary with the statistics for each tag class."""
+        return self._statistics
+
+
+def _indentation_prefix(options, level):
+    """Returns the string used for indenting lines at a level."""
+    width = level * options.indentation_factor
+    if options.tab_size and options.indentation_character == ' ':
+        return '\t' * (width // options.tab_size) + \
+            ' ' * (width % options.tab_size)
+    return options.indentation_character * width
+
+
 class TagBase(object):
-    """Base class for scope-based template tags."""
+    """Base class for scope-based template tags. Tags are compared and hashed
+    by structure: their class, their attributes and their children. The hash
+    is computed once and cached, so the tree must not be modified after it
+    is used, except through the children setters of the modified tag.
+
+    The attributes are stored in slots. Subclasses may define their own
+    __slots__ for a compact representation, otherwise their instances get a
+    __dict__ as usual. Tags get their own list of children, while the frozen
+    tags without children share an empty tuple.
+
+    Frozen tags, created by freeze, can't be modified."""
+
+    __slots__ = ('_children', '_children_defined', '_hash', '_frozen')
+
+    # Attributes which are not part of the structure of the tag.
+    TRANSIENT_ATTRIBUTES = frozenset(['_hash', '_frozen'])
 
     def __init__(self):
         self._children = []
         self._children_defined = False
+        self._hash = None
+        self._frozen = False
+
+    def __getstate__(self):
+        state = _tag_state(self)
+        if self.frozen:
+            state['_frozen'] = True
+        return state
+
+    def __setstate__(self, state):
+        for name in self.TRANSIENT_ATTRIBUTES:
+            setattr(self, name, None)
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def __repr__(self):
-        return '{0} {1}'.format(self.__class__.__name__, self.__dict__)
+        return '{0} {1}'.format(self.__class__.__name__, _tag_state(self))
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, TagBase):
+            return NotImplemented
+        return self is other or (hash(self) == hash(other) and
+                                 _tags_equal(self, other))
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        value = getattr(self, '_hash', None)
+        if value is None:
+            value = _structural_hash(self)
+        return value
 
     def set_children(self, value, defined):
         """Set the children of the object."""
@@ -128,7 +651,9 @@ class TagBase(object):
     @children.setter
     def children(self, value):
         """Set the children of the object."""
+        self._check_not_frozen()
         self._children = value
+        self._hash = None
 
     @property
     def children_defined(self):
@@ -139,12 +664,150 @@ class TagBase(object):
     @children_defined.setter
     def children_defined(self, value):
         """Set if the childrend was defined."""
+        self._check_not_frozen()
         self._children_defined = value
+        self._hash = None
+
+    @property
+    def frozen(self):
+        """Indicates if the tag was created by freeze."""
+        return bool(getattr(self, '_frozen', False))
+
+    def _check_not_frozen(self):
+        """Raises an error if the tag can't be modified."""
+        if getattr(self, '_frozen', False):
+            raise RuntimeError('Frozen tags can\'t be modified.')
+
+
+# Children of the frozen tags without children.
+_NO_CHILDREN = ()
+
+# Cache of the names of the slots of each class, including its bases.
+_SLOT_NAMES = {}
+
+
+def _slot_names(class_):
+    """Returns the names of the slots of a class and its bases."""
+    names = _SLOT_NAMES.get(class_)
+    if names is None:
+        names = []
+        for base in reversed(class_.__mro__):
+            slots = base.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            names.extend(name for name in slots
+                         if name not in ('__dict__', '__weakref__'))
+        names = _SLOT_NAMES[class_] = tuple(names)
+    return names
+
+
+def _shallow_copy(tag):
+    """Returns a new tag with the same attributes."""
+    class_ = tag.__class__
+    copy = class_.__new__(class_)
+    for name in _slot_names(class_):
+        try:
+            setattr(copy, name, getattr(tag, name))
+        except AttributeError:
+            pass
+    attributes = getattr(tag, '__dict__', None)
+    if attributes:
+        copy.__dict__.update(attributes)
+    return copy
+
+
+def _tag_state(tag):
+    """Returns the attributes defining the structure of a tag."""
+    transient = tag.TRANSIENT_ATTRIBUTES
+    state = {}
+    for name in _slot_names(tag.__class__):
+        if name not in transient and hasattr(tag, name):
+            state[name] = getattr(tag, name)
+    attributes = getattr(tag, '__dict__', None)
+    if attributes:
+        for name, value in attributes.items():
+            if name not in transient:
+                state[name] = value
+    return state
+
+
+def _value_hash(value):
+    """Hash of an attribute or leaf of a tag, for values which may be mutable
+    or not hashable at all."""
+    try:
+        return hash(_freeze(value))
+    except TypeError:
+        return hash(value.__class__.__name__)
+
+
+def _structural_hash(tag):
+    """Computes the hash of a tag and its descendants, bottom-up and without
+    recursion. The hashes are cached in the tags."""
+    stack = [(tag, False)]
+    while stack:
+        current, ready = stack.pop()
+        if getattr(current, '_hash', None) is not None:
+            continue
+        children = current.children
+        if not ready:
+            stack.append((current, True))
+            stack.extend((child, False)
+                         for child in children
+                         if isinstance(child, TagBase))
+            continue
+        state = _tag_state(current)
+        state.pop('_children', None)
+        current._hash = hash((
+            current.__class__,
+            _value_hash(state),
+            tuple(hash(child) if isinstance(child, TagBase)
+                  else _value_hash(child)
+                  for child in children)
+        ))
+    return tag._hash
+
+
+def _tags_equal(first, second):
+    """Compares two tags and their descendants, without recursion. The
+    cached hashes are used for discarding different subtrees quickly."""
+    pending = [(first, second)]
+    while pending:
+        first, second = pending.pop()
+        if first is second:
+            continue
+        if first.__class__ is not second.__class__:
+            return False
+        first_hash = getattr(first, '_hash', None)
+        second_hash = getattr(second, '_hash', None)
+        if first_hash is not None and second_hash is not None and \
+                first_hash != second_hash:
+            return False
+        first_state = _tag_state(first)
+        second_state = _tag_state(second)
+        first_state.pop('_children', None)
+        second_state.pop('_children', None)
+        if first_state != second_state:
+            return False
+        first_children = first.children
+        second_children = second.children
+        if len(first_children) != len(second_children):
+            return False
+        for first_child, second_child in zip(first_children,
+                                             second_children):
+            if isinstance(first_child, TagBase) and \
+                    isinstance(second_child, TagBase):
+                pending.append((first_child, second_child))
+            elif first_child is not second_child and \
+                    first_child != second_child:
+                return False
+    return True
 
 
 class Tag(object):
     """Handler for tag implementations."""
 
+    __slots__ = ('_class',)
+
     def __init__(self, class_):
         self._class = class_
 
@@ -159,13 +822,22 @@ class Tag(object):
 
     def _flatten(self):
         """Creates a 'flat' representation of itself."""
-        return _TagImpl(self._class).set_arguments()._flatten()
+        return _flatten(self)
+
+    def _open(self):
+        """Returns a new element for the tag and its pending children."""
+        return _TagImpl(self._class).set_arguments()._open()
+
+    # The element is always new.
+    _open_copy = _open
 
 
 class IndentTag(TagBase):
     """Represents an indent tag, the children will be printed with increased
     indentation."""
 
+    __slots__ = ()
+
     def serialize(self, context):
         context.indent()
         for child in self.children:
@@ -176,13 +848,63 @@ class IndentTag(TagBase):
 class NewLineTag(TagBase):
     """Represents a blank line tag."""
 
+    __slots__ = ()
+
     def serialize(self, context):
         context.new_line()
 
 
+class LazyForEachTag(TagBase):
+    """Represents a for_each block which is expanded during the serialization.
+    The generated elements are flattened and serialized one item at a time,
+    so they are never held in memory all together."""
+
+    __slots__ = ('_iterable', '_function')
+
+    def __init__(self, iterable, function):
+        super(LazyForEachTag, self).__init__()
+        self._iterable = iterable
+        self._function = function
+
+    def serialize(self, context):
+        for item in self._items(context):
+            self._serialize_item(context, item)
+
+    def _items(self, context):
+        """Returns an iterator over the items of the block. The context is
+        None when the block is expanded outside of a serialization."""
+        return iter(self._iterable)
+
+    def _serialize_item(self, context, item):
+        """Flatten and serialize the elements generated for an item."""
+        flatten = context._flatten_generated  # pylint: disable-msg=W0212
+        for child in flatten(self._function(item)):
+            context.serialize(child)
+
+    def expand(self, context):
+        """Generates the flattened elements of the block, for tags which
+        need to look at them before serializing them."""
+        flatten = context._flatten_generated  # pylint: disable-msg=W0212
+        for item in self._items(context):
+            for child in flatten(self._function(item)):
+                yield child
+
+    @property
+    def iterable(self):
+        """Elements used for generating the children."""
+        return self._iterable
+
+    @property
+    def function(self):
+        """Function generating the children for each element."""
+        return self._function
+
+
 class _TagImpl(object):
     """Proxy object to manage a tag before it becomes flattened."""
 
+    __slots__ = ('_class', '_children', '_children_defined', '_element')
+
     def __init__(self, class_):
         self._class = class_
         self._children = []
@@ -205,27 +927,47 @@ class _TagImpl(object):
         raise RuntimeError('Should not be used.')
 
     def _flatten(self):
-        itrs = (_flatten(t) for t in self._children)
-        self._element.children = list(itertools.chain.from_iterable(itrs))
+        return _flatten(self)
+
+    def _open(self):
+        """Prepares the element to receive its flattened children. Returns
+        the element and the children still to be flattened."""
+        self._element.children = []
         self._element.children_defined = self._children_defined
-        return [self._element]
+        return self._element, self._children
+
+    def _open_copy(self):
+        """Like _open, but the element is a shallow copy, so the element of
+        the tag, which may be part of a tree flattened before, isn't
+        modified."""
+        copy = _shallow_copy(self._element)
+        copy.children = []
+        copy.children_defined = self._children_defined
+        return copy, self._children
 
 
 class _ForEachTag(object):
     """Helper tag class for representing the for_each function."""
 
+    __slots__ = ('_iterable', '_function')
+
     def __init__(self, iterable, function):
         self._iterable = iterable
         self._function = function
 
     def _flatten(self):
-        iterables = (_flatten(self._function(t)) for t in self._iterable)
-        return list(itertools.chain.from_iterable(iterables))
+        return _flatten(self)
+
+    def _inline(self):
+        """Children to be appended to the parent."""
+        return (self._function(t) for t in self._iterable)
 
 
 class _SpanTagImpl(object):
     """Represents a span block."""
 
+    __slots__ = ('_children',)
+
     def __init__(self):
         self._children = []
 
@@ -238,8 +980,11 @@ class _SpanTagImpl(object):
         return self
 
     def _flatten(self):
-        iterables = (_flatten(t) for t in self._children)
-        return list(itertools.chain.from_iterable(iterables))
+        return _flatten(self)
+
+    def _inline(self):
+        """Children to be appended to the parent."""
+        return self._children
 
 
 class _SpanTag(object):
@@ -251,7 +996,11 @@ class _SpanTag(object):
         raise RuntimeError('Should not be used.')
 
     def _flatten(self):
-        return _SpanTagImpl()._flatten()
+        return []
+
+    def _inline(self):
+        """Children to be appended to the parent."""
+        return ()
 
 
 class _NothingTag(object):
@@ -260,9 +1009,17 @@ class _NothingTag(object):
     def _flatten(self):
         return []
 
+    def _inline(self):
+        """Children to be appended to the parent."""
+        return ()
 
-def for_each(elements, function):
-    """Allows to generate a tag for each items in an enumarable."""
+
+def for_each(elements, function, lazy=False):
+    """Allows to generate a tag for each items in an enumarable. If lazy is
+    set, the items are not consumed when flattening the template but while it
+    is being serialized. Iterators can then be serialized only once."""
+    if lazy:
+        return LazyForEachTag(elements, function)
     return _ForEachTag(elements, function)
 
 # Indent elements in the block.
@@ -278,22 +1035,1010 @@ new_line = Tag(NewLineTag)  # pylint: disable-msg=C0103
 nothing = _NothingTag()     # pylint: disable-msg=C0103
 
 
-def serialize(template, options=SerializerOptions()):
+def serialize(template, options=SerializerOptions(), workers=None,
+              executor=None, cache=None, hooks=None, fused=False):
     """Serialize the provided template according to the language
-    specifications."""
-    context = SerializerContext(options)
-    context.serialize(flatten(template))
+    specifications. If workers or an executor are provided, the children of
+    the top-level tag are serialized in parallel (see serialize_many). A
+    render cache for reusing the output of elements, and hooks observing the
+    serialization, can be provided, but these are not used by a parallel
+    serialization.
+
+    If fused is set, the template is flattened while it is serialized, one
+    element at a time, instead of creating the whole flattened tree first.
+    The children of each element are only kept while it is serialized. A
+    render cache can't be used in this mode."""
+    if workers is None and executor is None:
+        if fused:
+            context = _FusedContext(options, cache=cache, hooks=hooks)
+            context.serialize_template(template)
+        else:
+            context = SerializerContext(options, cache=cache, hooks=hooks)
+            context.serialize(_flatten_template(template, options,
+                                                cache is not None))
+        return context.output
+
+    context = _ParallelContext(options,
+                               _flatten_expanded(template, options))
+    context.serialize(context.root)
+    with _Executor(workers, executor) as pool:
+        context.render_slots(pool, workers)
     return context.output
 
 
+def serialize_many(templates, options=SerializerOptions(), workers=None,
+                   executor=None):
+    """Serialize a list of templates in parallel, returning the list of
+    outputs. The templates are flattened in the calling process, and then
+    serialized by a process pool with the given number of workers or by the
+    provided concurrent.futures executor. When using processes, the flattened
+    templates and the options must be picklable. Lazy for_each blocks are
+    expanded before, so their functions don't need to be picklable."""
+    flattened = [_flatten_expanded(template, options)
+                 for template in templates]
+    with _Executor(workers, executor) as pool:
+        futures = [pool.submit(serialize, template, options)
+                   for template in flattened]
+        return [future.result() for future in futures]
+
+
+def serialize_batch(template_function, records, options=SerializerOptions(),
+                    sink=None, workers=None, executor=None, chunk_size=1000):
+    """Serialize the template created by template_function for each one of
+    the records, reusing the same context, and so the resolved options and
+    the buffers, for all of them. Returns the list of outputs, or if a sink
+    is provided, writes the outputs to it one after the other.
+
+    If workers or an executor are provided, the records are split in chunks
+    of chunk_size which are serialized in parallel (see serialize_many). The
+    template function must then be picklable, for example a function defined
+    at module level, as well as the records."""
+    if workers is None and executor is None:
+        if sink is not None:
+            context = SerializerContext(options, sink=sink)
+            for record in records:
+                template = template_function(record)
+                context.serialize(_flatten_template(template, options))
+            context.flush()
+            return None
+        return _serialize_records(template_function, records, options)
+
+    records = iter(records)
+    chunks = iter(lambda: list(itertools.islice(records, chunk_size)), [])
+    outputs = []
+
+    def collect(future):
+        if sink is None:
+            outputs.extend(future.result())
+        else:
+            sink.write(''.join(future.result()))
+
+    with _Executor(workers, executor) as pool:
+        # Only a few chunks are submitted ahead, so the records are consumed
+        # as the results are used.
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_serialize_records,
+                                       template_function, chunk, options))
+            if len(pending) >= 2 * (workers or 1):
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    return outputs if sink is None else None
+
+
+def _serialize_records(template_function, records, options):
+    """Serialize the template for each record with a single context."""
+    context = SerializerContext(options)
+    outputs = []
+    for record in records:
+        template = template_function(record)
+        context.serialize(_flatten_template(template, options))
+        outputs.append(context.take_output())
+    return outputs
+
+
+def serialize_variants(template, variants):
+    """Serialize the provided template with each one of the options in the
+    list of variants, returning the list of outputs. The template is
+    flattened once, and it is serialized once for each group of variants
+    differing only in the indentation options: the lines are recorded with
+    their indentation level, and then each variant gets its own
+    indentation. Lazy for_each blocks are expanded once, before serializing
+    the first group, so their iterables may be generators.
+
+    The tags must produce their output through the context, and not depend
+    on the indentation options."""
+    variants = list(variants)
+    if not variants:
+        return []
+    tree = _flatten_expanded(template, variants[0])
+    recorders = {}
+    outputs = []
+    for options in variants:
+        key = _variant_key(options)
+        recorder = recorders.get(key)
+        if recorder is None:
+            recorder = recorders[key] = _RecorderContext(options)
+            with _interning(options):
+                recorder.serialize(tree)
+        outputs.append(recorder.render(options))
+    return outputs
+
+
+# Options which only change the indentation of the lines.
+_INDENTATION_OPTIONS = frozenset([
+    '_indentation_character', '_indentation_factor', '_tab_size',
+    '_max_indentation_level', '_intern_table'
+])
+
+
+def _variant_key(options):
+    """Returns a key for the options, equal for options differing only in
+    the indentation."""
+    key = _freeze(dict((name, value)
+                       for name, value in options.__dict__.items()
+                       if name not in _INDENTATION_OPTIONS))
+    try:
+        hash(key)
+    except TypeError:
+        return id(options)
+    return key
+
+
+class _RecorderContext(SerializerContext):
+    """Context recording the lines with their indentation level, so they can
+    be rendered with several indentation options."""
+
+    def __init__(self, options):
+        super(_RecorderContext, self).__init__(options)
+        self._levels = []
+        self._lines = []
+        self._max_recorded = 0
+
+    def write(self, string):
+        # Levels below zero aren't indented.
+        self._levels.append(self._level if self._level > 0 else 0)
+        self._lines.append(string)
+
+    def write_block(self, text):
+        for line in text.splitlines():
+            self.write(line)
+
+    def new_line(self):
+        self._levels.append(0)
+        self._lines.append('')
+
+    def _set_level(self, level):
+        self._level = level
+        if level > self._max_recorded:
+            self._max_recorded = level
+
+    def render(self, options):
+        """Returns the output with the indentation of the options."""
+        max_level = options.max_indentation_level
+        if max_level is not None and self._max_recorded > max_level:
+            raise ValueError('Maximum indentation level exceeded.')
+        if not self._lines:
+            return ''
+        prefixes = [_indentation_prefix(options, level)
+                    for level in range(0, self._max_recorded + 1)]
+        return '\n'.join(map(operator.add,
+                             map(prefixes.__getitem__, self._levels),
+                             self._lines)) + '\n'
+
+
+def serialize_to(template, fileobj, options=SerializerOptions(), cache=None,
+                 hooks=None, fused=False):
+    """Serialize the provided template, writing the output incrementally to
+    a file-like object. See serialize for the fused mode."""
+    if fused:
+        context = _FusedContext(options, sink=fileobj, cache=cache,
+                                hooks=hooks)
+        context.serialize_template(template)
+    else:
+        context = SerializerContext(options, sink=fileobj, cache=cache,
+                                    hooks=hooks)
+        context.serialize(_flatten_template(template, options,
+                                            cache is not None))
+    context.flush()
+
+
+# Results of the emit function.
+EMIT_CREATED = 'created'
+EMIT_UPDATED = 'updated'
+EMIT_UNCHANGED = 'unchanged'
+
+
+def emit(template, path, options=SerializerOptions(), encoding='utf-8',
+         cache=None):
+    """Serialize the provided template into a file, only if its content would
+    change. The output is compared with the existing file while it is being
+    generated, and it is written to a temporary file renamed over the target
+    only once complete. Line endings are written as generated. If the path is
+    a symbolic link, the file it points to is replaced, and the link is kept.
+    Returns EMIT_CREATED, EMIT_UPDATED or EMIT_UNCHANGED."""
+    sink = _EmitSink(path, encoding)
+    try:
+        serialize_to(template, sink, options, cache)
+        return sink.finish()
+    finally:
+        sink.close()
+
+
+class _EmitSink(object):
+    """Sink comparing the output with the content of a file. A temporary file
+    is only written after the first difference is found."""
+
+    # Size of the blocks copied from the existing file.
+    BLOCK_SIZE = 65536
+
+    def __init__(self, path, encoding):
+        self._path = os.path.realpath(path)
+        self._encoding = encoding
+        self._matched = 0
+        self._temp = None
+        self._temp_path = None
+        try:
+            self._existing = open(self._path, 'rb')
+        except (IOError, OSError):
+            self._existing = None
+            self._start_temp()
+
+    def write(self, string):
+        """Compare a chunk with the file, or write it if there was a
+        difference already."""
+        data = string.encode(self._encoding)
+        if self._temp is None:
+            if self._existing.read(len(data)) == data:
+                self._matched += len(data)
+                return
+            self._start_temp()
+        self._temp.write(data)
+
+    def finish(self):
+        """Replace the file if the content changed."""
+        if self._temp is None:
+            if not self._existing.read(1):
+                return EMIT_UNCHANGED
+            self._start_temp()
+        created = self._existing is None
+        self._temp.close()
+        if not created:
+            self._existing.close()
+            shutil.copymode(self._path, self._temp_path)
+        _replace_file(self._temp_path, self._path)
+        self._temp_path = None
+        return EMIT_CREATED if created else EMIT_UPDATED
+
+    def close(self):
+        """Release the files, removing the temporary file if it wasn't
+        used."""
+        if self._existing is not None:
+            self._existing.close()
+        if self._temp is not None:
+            self._temp.close()
+        if self._temp_path is not None:
+            os.remove(self._temp_path)
+            self._temp_path = None
+
+    def _start_temp(self):
+        directory, name = os.path.split(self._path)
+        # The file is created with the permissions of a new file, so the
+        # umask applies to it as for the target.
+        flags = os.O_CREAT | os.O_EXCL | os.O_WRONLY | \
+            getattr(os, 'O_BINARY', 0)
+        while True:
+            path = os.path.join(directory, '.{0}.{1:08x}.tmp'.format(
+                name, random.getrandbits(32)))
+            try:
+                handle = os.open(path, flags, 0o666)
+                break
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+        self._temp_path = path
+        self._temp = os.fdopen(handle, 'wb')
+        if self._matched:
+            self._existing.seek(0)
+            remaining = self._matched
+            while remaining > 0:
+                block = self._existing.read(
+                    min(remaining, _EmitSink.BLOCK_SIZE))
+                self._temp.write(block)
+                remaining -= len(block)
+
+
+def _replace_file(source, destination):
+    """Rename a file, replacing the destination atomically if possible."""
+    replace = getattr(os, 'replace', None)
+    if replace is not None:
+        replace(source, destination)
+    else:
+        if os.name == 'nt' and os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def iter_serialize(template, options=SerializerOptions(), cache=None):
+    """Serialize the provided template, yielding the output in chunks as it is
+    generated. The serialization runs in a separate thread, which is blocked
+    while the consumer doesn't request more chunks."""
+    sink = _QueueSink()
+    thread = threading.Thread(target=sink.run,
+                              args=(template, options, cache))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = sink.chunks.get()
+            if item is _QueueSink.END:
+                break
+            elif isinstance(item, _SerializationFailure):
+                raise item.error
+            yield item
+    finally:
+        sink.cancelled = True
+
+
+class _SerializationFailure(object):
+    """Exception raised by the serialization thread."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _SerializationCancelled(Exception):
+    """Raised in the serialization thread when the consumer stopped."""
+
+
+class _QueueSink(object):
+    """Sink handing the output of a serialization thread to a consumer."""
+
+    END = object()
+
+    # Maximum number of chunks waiting for the consumer.
+    SIZE = 16
+
+    def __init__(self):
+        self.chunks = queue.Queue(_QueueSink.SIZE)
+        self.cancelled = False
+
+    def run(self, template, options, cache):
+        """Serialize the template into the queue."""
+        try:
+            serialize_to(template, self, options, cache)
+            item = _QueueSink.END
+        except _SerializationCancelled:
+            return
+        except Exception:  # pylint: disable-msg=W0703
+            item = _SerializationFailure(sys.exc_info()[1])
+        try:
+            self._put(item)
+        except _SerializationCancelled:
+            pass
+
+    def write(self, string):
+        """Hand a chunk of output to the consumer."""
+        self._put(string)
+
+    def _put(self, item):
+        while True:
+            if self.cancelled:
+                raise _SerializationCancelled()
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def compile(template_factory,  # pylint: disable-msg=W0622
+            options=SerializerOptions()):
+    """Compiles a function creating a template into a CompiledTemplate, which
+    renders the output for new arguments without creating, flattening and
+    serializing the template again. The function is called once, with a
+    placeholder string for each argument, so the structure of the template
+    must not depend on the values of the arguments, and these can only be
+    used as text. The values are inserted in the output as they are.
+
+    The function is then called with a few sample arguments, and a
+    ValueError is raised if the compiled template doesn't render the same
+    output for them, for example if the arguments are transformed with
+    string methods like upper or strip."""
+    return CompiledTemplate(template_factory, options)
+
+
+class CompiledTemplate(object):
+    """Output of a template, with slots for the arguments of the function
+    that created it."""
+
+    def __init__(self, template_factory, options=SerializerOptions()):
+        self._names, self._defaults = _argument_names(template_factory)
+        placeholders = [_Placeholder.create(index)
+                        for index in range(0, len(self._names))]
+        output = serialize(template_factory(* placeholders), options)
+        parts = _PLACEHOLDER_PATTERN.split(output)
+        literals = parts[0::2]
+        if any(_PLACEHOLDER_MARK in literal for literal in literals):
+            raise ValueError('The arguments of a compiled template can only '
+                             'be used as text.')
+        # The output becomes a format string with a field for each slot.
+        escaped = [literal.replace('{', '{{').replace('}', '}}')
+                   for literal in literals]
+        fields = ['{' + index + '}' for index in parts[1::2]]
+        self._format = escaped[0] + ''.join(
+            field + literal for field, literal in zip(fields, escaped[1:]))
+        self._indexes = dict((name, index)
+                             for index, name in enumerate(self._names))
+        for sample in _COMPILE_SAMPLES:
+            values = [sample.format(index)
+                      for index in range(0, len(self._names))]
+            if self.render(* values) != \
+                    serialize(template_factory(* values), options):
+                raise ValueError('The arguments of a compiled template can '
+                                 'only be used as text, without changes.')
+
+    def render(self, * args, ** kwargs):
+        """Returns the output of the template for the given arguments."""
+        if len(args) > len(self._names):
+            raise TypeError('Too many arguments for the template.')
+        values = list(args)
+        values.extend(_MISSING for _ in range(len(args), len(self._names)))
+        for name, value in kwargs.items():
+            index = self._indexes.get(name)
+            if index is None:
+                raise TypeError('Unknown argument: {0}.'.format(name))
+            values[index] = value
+        for index, value in enumerate(values):
+            if value is _MISSING:
+                default = self._defaults.get(index, _MISSING)
+                if default is _MISSING:
+                    raise TypeError('Missing argument: {0}.'.format(
+                        self._names[index]))
+                values[index] = default
+        return self._format.format(* values)
+
+    @property
+    def names(self):
+        """Names of the arguments of the template."""
+        return self._names
+
+
+# Marks around the index of a placeholder in the traced output.
+_PLACEHOLDER_MARK = '\x00'
+_PLACEHOLDER_PATTERN = re.compile('\x00(\\d+)\x00')
+
+# Value of the arguments not provided.
+_MISSING = object()
+
+# Formats of the sample arguments used for checking compiled templates. They
+# change with case conversions and stripping.
+_COMPILE_SAMPLES = (' aB{0} ', 'Zy{0}x\t')
+
+
+class _Placeholder(str):
+    """String standing for an argument while tracing a template."""
+
+    __slots__ = ()
+
+    @staticmethod
+    def create(index):
+        """Returns the placeholder for the argument at the index."""
+        return _Placeholder('{0}{1}{0}'.format(_PLACEHOLDER_MARK, index))
+
+
+def _argument_names(function):
+    """Returns the names of the arguments of a function, and a dictionary
+    with the default values by position."""
+    getargspec = getattr(inspect, 'getfullargspec', None) or \
+        inspect.getargspec  # pylint: disable-msg=E1101
+    spec = getargspec(function)
+    if spec[1] is not None or spec[2] is not None or \
+            getattr(spec, 'kwonlyargs', None):
+        raise TypeError('Compiled templates only support positional '
+                        'arguments.')
+    names = tuple(spec.args)
+    if inspect.ismethod(function):
+        names = names[1:]
+    defaults = spec.defaults or ()
+    first = len(names) - len(defaults)
+    return names, dict((first + i, value) for i, value in enumerate(defaults))
+
+
+class IncrementalSerializer(object):
+    """Serializes successive versions of a template, re-rendering only the
+    elements which changed since the previous version. The output of each
+    element of the last version is kept, identified by the structure of the
+    element and its indentation, and unchanged elements are copied from it
+    into the new output."""
+
+    def __init__(self, options=SerializerOptions()):
+        self._options = options
+        self._entries = {}
+        self._rendered = 0
+        self._reused = 0
+
+    def serialize(self, template):
+        """Serialize a new version of the template."""
+        cache = _IncrementalCache(self._entries)
+        context = SerializerContext(self._options, cache=cache)
+        context.serialize(_flatten_template(template, self._options, True))
+        self._entries = cache.current
+        self._rendered = cache.misses
+        self._reused = cache.hits
+        return context.output
+
+    def reset(self):
+        """Discards the output of the previous version."""
+        self._entries = {}
+
+    @property
+    def rendered(self):
+        """Number of elements serialized in the last version."""
+        return self._rendered
+
+    @property
+    def reused(self):
+        """Number of elements copied from the previous version, in the last
+        version. The descendants of these are not included."""
+        return self._reused
+
+
+class _IncrementalCache(object):
+    """Render cache for an IncrementalSerializer. It builds the entries for
+    the new version, keeping the entries of the elements reused from the
+    previous version together with their descendants."""
+
+    def __init__(self, previous):
+        self._previous = previous
+        self.current = {}
+        self.hits = 0
+        self.misses = 0
+        # Keys of the children of the elements being serialized.
+        self._children = [[]]
+
+    @staticmethod
+    def key(tag, options_key, level):
+        """Key for the output of an element, by structure."""
+        return (tag, options_key, level)
+
+    def get(self, key):
+        """Returns the output of the element in the previous version, or None
+        if it must be serialized."""
+        entry = self.current.get(key) or self._previous.get(key)
+        if entry is None:
+            self.misses += 1
+            self._children.append([])
+            return None
+        self.hits += 1
+        self._keep(key, entry)
+        self._children[-1].append(key)
+        return entry[0]
+
+    def put(self, key, value):
+        """Stores the output of a serialized element."""
+        self.current[key] = (value, self._children.pop())
+        self._children[-1].append(key)
+
+    def _keep(self, key, entry):
+        pending = [(key, entry)]
+        while pending:
+            key, entry = pending.pop()
+            if key not in self.current:
+                self.current[key] = entry
+                pending.extend((child, self._previous[child])
+                               for child in entry[1]
+                               if child in self._previous)
+
+
+class _Executor(object):
+    """Provides the executor used for a parallel serialization. A process
+    pool is created, and shut down afterwards, if no executor is given."""
+
+    def __init__(self, workers, executor):
+        self._workers = workers
+        self._executor = executor
+        self._owned = executor is None
+
+    def __enter__(self):
+        if self._owned:
+            try:
+                import concurrent.futures
+            except ImportError:
+                raise ImportError('Parallel serialization requires the '
+                                  'concurrent.futures module (futures '
+                                  'package in Python 2).')
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self._workers)
+        return self._executor
+
+    def __exit__(self, * args):
+        if self._owned:
+            self._executor.shutdown()
+
+
+class _ParallelContext(SerializerContext):
+    """Context leaving a slot in the output for each child of the root
+    element, so they can be serialized in parallel afterwards."""
+
+    # Number of tasks submitted for each worker, for balancing the load.
+    TASKS_PER_WORKER = 4
+
+    def __init__(self, options, root):
+        super(_ParallelContext, self).__init__(options)
+        self.root = root
+        self._top_level = set(id(child)
+                              for child in getattr(root, 'children', ())
+                              if isinstance(child, TagBase))
+        self._slots = []
+
+    def serialize(self, tag):
+        if id(tag) in self._top_level:
+            self._slots.append((len(self._chunks), tag, self._level))
+            self._chunks.append('')
+        else:
+            super(_ParallelContext, self).serialize(tag)
+
+    def render_slots(self, executor, workers):
+        """Serialize the children in the slots and place their output."""
+        if not self._slots:
+            return
+        tasks = (workers or 1) * _ParallelContext.TASKS_PER_WORKER
+        size = max(1, -(-len(self._slots) // tasks))
+        batches = [self._slots[i:i + size]
+                   for i in range(0, len(self._slots), size)]
+        futures = [executor.submit(_serialize_slots,
+                                   [(tag, level) for _, tag, level in batch],
+                                   self._options)
+                   for batch in batches]
+        for batch, future in zip(batches, futures):
+            for (index, _, _), output in zip(batch, future.result()):
+                self._chunks[index] = output
+
+
+class _FusedContext(SerializerContext):
+    """Context flattening the template while serializing it. The elements
+    are created with their children pending, and these are flattened each
+    time the element is serialized, and released afterwards. The pending
+    children of an element are kept while its parent is serialized, so it
+    can be serialized more than once."""
+
+    def __init__(self, options, sink=None, cache=None, hooks=None):
+        if cache is not None:
+            raise ValueError('A render cache can\'t be used in fused mode.')
+        # Elements of the flattened children of the elements being
+        # serialized, with their pending children, by id.
+        self._pending = {}
+        super(_FusedContext, self).__init__(options, sink=sink, hooks=hooks)
+
+    def serialize_template(self, template):
+        """Serialize the first element of the template."""
+        with _interning(self.options):
+            root = _flatten_shallow(template, self._pending)[0]
+            try:
+                self.serialize(root)
+            finally:
+                self._pending.clear()
+
+    def serialize(self, tag):
+        if _SERIALIZABLE_TYPES.get(tag.__class__) is False:
+            self.write(str(tag))
+            return
+        pending = self._pending
+        entry = pending.get(id(tag))
+        if entry is None or not entry[1]:
+            SerializerContext.serialize(self, tag)
+            return
+        tag.children = _flatten_shallow(entry[1], pending, True)
+        try:
+            SerializerContext.serialize(self, tag)
+        finally:
+            for child in tag.children:
+                pending.pop(id(child), None)
+            tag.children = []
+
+
+def _serialize_slots(slots, options):
+    """Serialize each element with its base indentation level."""
+    outputs = []
+    for tag, level in slots:
+        context = SerializerContext(options)
+        context._set_level(level)  # pylint: disable-msg=W0212
+        context.serialize(tag)
+        outputs.append(context.output)
+    return outputs
+
+
 def flatten(template):
     """Creates a 'flat' version of the template. It process special tags to
-    create a simple structure for the template."""
+    create a simple structure for the template. The strings are interned in
+    the active InternTable, if any."""
     return _flatten(template)[0]
 
 
-def _flatten(value):
-    try:
-        return value._flatten()
-    except (AttributeError, TypeError):
-        return [value]
+def _flatten_template(template, options, copy=False):
+    """Flattens a template for a serialization. See _flatten for copy."""
+    return _flatten_with(template, options, copy)[0]
+
+
+def _flatten_with(value, options, copy=False):
+    """Flattens a value into a list of elements, with the intern table of the
+    options active."""
+    with _interning(options):
+        return _flatten(value, copy)
+
+
+def _flatten_expanded(template, options):
+    """Flattens a template, expanding its lazy for_each blocks, for
+    serializing it more than once or in other processes, where lazy blocks
+    can't be sent."""
+    with _interning(options):
+        return _expand_lazy_tree(_expand_lazy(_flatten(template))[0])
+
+
+def _expand_lazy_tree(root):
+    """Returns the flattened template with its lazy for_each blocks expanded.
+    The elements containing lazy blocks, and their ancestors, are copied, so
+    an already flattened template is not modified. Frozen elements don't
+    contain lazy blocks."""
+    # Expanded version of each element, by the id of the original.
+    copies = {}
+    stack = [(root, False)]
+    while stack:
+        tag, ready = stack.pop()
+        if id(tag) in copies:
+            continue
+        if not isinstance(tag, TagBase) or tag.frozen:
+            copies[id(tag)] = tag
+            continue
+        if not ready:
+            stack.append((tag, True))
+            stack.extend((child, False) for child in tag.children
+                         if isinstance(child, TagBase))
+            continue
+        children = []
+        changed = False
+        for child in tag.children:
+            if isinstance(child, LazyForEachTag):
+                for element in _expand_lazy((child,)):
+                    _expand_lazy_owned(element)
+                    children.append(element)
+                changed = True
+            else:
+                expanded = copies.get(id(child), child)
+                children.append(expanded)
+                changed = changed or expanded is not child
+        if changed:
+            copy = _shallow_copy(tag)
+            copy.children = children
+            copies[id(tag)] = copy
+        else:
+            copies[id(tag)] = tag
+    return copies[id(root)]
+
+
+def _expand_lazy_owned(root):
+    """Expands the lazy for_each blocks of a flattened template in place,
+    for templates just flattened from the generated elements of a lazy
+    block, which are not shared."""
+    stack = [root]
+    while stack:
+        tag = stack.pop()
+        if not isinstance(tag, TagBase) or tag.frozen:
+            continue
+        children = tag.children
+        if any(isinstance(child, LazyForEachTag) for child in children):
+            children = tag.children = _expand_lazy(children)
+        stack.extend(children)
+
+
+class _NoInternTable(object):
+    """Context manager doing nothing, used when there is no intern table."""
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NO_INTERN_TABLE = _NoInternTable()
+
+
+def _interning(options):
+    """Returns a context manager activating the intern table of the
+    options, if any."""
+    if options.intern_table is None:
+        return _NO_INTERN_TABLE
+    return options.intern_table
+
+
+def freeze(template):
+    """Creates an immutable version of the flattened template. The elements
+    are copies, with their children in tuples, and the tags of the template
+    are not modified afterwards. Lazy for_each blocks are expanded, and the
+    strings in the elements are interned in the active InternTable, if any.
+
+    A frozen tree may be serialized many times, also from several threads at
+    once, and included in other templates. Frozen elements found in the
+    template are shared instead of copied."""
+    root = _expand_lazy(_flatten(template))[0]
+    if not isinstance(root, TagBase) or root.frozen:
+        return root
+    table = _active_intern_table()
+    # Copies of the elements by the id of the original, and the expanded
+    # children of the elements being copied.
+    copies = {}
+    expanded = {}
+    stack = [(root, False)]
+    while stack:
+        tag, ready = stack.pop()
+        if id(tag) in copies:
+            continue
+        if tag.frozen:
+            copies[id(tag)] = tag
+            continue
+        if not ready:
+            children = expanded[id(tag)] = _expand_lazy(tag.children)
+            stack.append((tag, True))
+            stack.extend((child, False) for child in children
+                         if isinstance(child, TagBase))
+            continue
+        state = _tag_state(tag)
+        state.pop('_children', None)
+        children = expanded.pop(id(tag))
+        if table is not None:
+            for name, value in state.items():
+                state[name] = table.intern(value)
+            children = [table.intern(child) for child in children]
+        copy = tag.__class__.__new__(tag.__class__)
+        copy.__setstate__(state)
+        copy._children = tuple(
+            copies[id(child)] if isinstance(child, TagBase) else child
+            for child in children) or _NO_CHILDREN
+        _structural_hash(copy)
+        copy._frozen = True
+        copies[id(tag)] = copy
+    return copies[id(root)]
+
+
+def _expand_lazy(values):
+    """Returns a list with the values, replacing the lazy for_each blocks by
+    their flattened elements."""
+    result = []
+    stack = [iter(values)]
+    while stack:
+        for value in stack[-1]:
+            if isinstance(value, LazyForEachTag):
+                stack.append(_lazy_elements(value))
+                break
+            result.append(value)
+        else:
+            stack.pop()
+    return result
+
+
+def _lazy_elements(tag):
+    """Generates the flattened elements of a lazy for_each block."""
+    for item in tag._items(None):  # pylint: disable-msg=W0212
+        for element in _flatten(tag.function(item)):
+            yield element
+
+
+def _freeze(value):
+    """Returns a hashable representation of a value, converting the
+    containers to immutable ones."""
+    if isinstance(value, dict):
+        return frozenset((_freeze(k), _freeze(v)) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
+
+# Kinds of values found while flattening a template. Elements of the
+# flattened tree are created by the tags implementing _open, like Tag, and
+# the tags implementing _inline, like span, append their children to the
+# parent.
+_LEAF, _ELEMENT, _INLINE, _CUSTOM = range(4)
+
+# Cache of the flattening kind of each class.
+_FLATTEN_KINDS = {}
+
+# Cache indicating if instances of a class implement a serialize method.
+_SERIALIZABLE_TYPES = {}
+
+
+def _flatten_kind(class_):
+    """Returns how values of a class are flattened."""
+    if callable(getattr(class_, '_open', None)):
+        kind = _ELEMENT
+    elif callable(getattr(class_, '_inline', None)):
+        kind = _INLINE
+    elif callable(getattr(class_, '_flatten', None)):
+        kind = _CUSTOM
+    else:
+        kind = _LEAF
+    _FLATTEN_KINDS[class_] = kind
+    return kind
+
+
+def _is_serializable(class_):
+    """Returns if instances of a class implement a serialize method."""
+    serializable = callable(getattr(class_, 'serialize', None))
+    _SERIALIZABLE_TYPES[class_] = serializable
+    return serializable
+
+
+def _flatten_shallow(values, pending, many=False):
+    """Flattens a value, or a list of values if many is set, without
+    flattening the children of the elements. The elements are new, or copies
+    of the elements of the tags, which aren't modified. Their children are
+    stored in the pending dictionary instead, by the id of the element."""
+    result = []
+    table = _active_intern_table()
+    stack = [iter(values if many else (values,))]
+    while stack:
+        for child in stack[-1]:
+            kind = _FLATTEN_KINDS.get(child.__class__)
+            if kind is None:
+                kind = _flatten_kind(child.__class__)
+            if kind == _LEAF:
+                if table is not None:
+                    child = table.intern(child)
+                result.append(child)
+            elif kind == _ELEMENT:
+                element, children = child._open_copy()
+                pending[id(element)] = (element, children)
+                result.append(element)
+            elif kind == _INLINE:
+                stack.append(iter(child._inline()))
+                break
+            else:
+                result.extend(child._flatten())
+        else:
+            stack.pop()
+    return result
+
+
+def _flatten(value, copy=False):
+    """Flattens a value into a list of elements. It uses an explicit stack
+    instead of recursion, so the depth of the template is not limited, and
+    the children are appended directly to the list of their final parent.
+
+    The elements of the tags are reused by each flattening, unless copy is
+    set, for serializations with a render cache identifying the elements."""
+    result = []
+    table = _active_intern_table()
+    # Each frame holds an iterator over the children still to be flattened,
+    # and the list where the flattened children are appended.
+    stack = [(iter((value,)), result)]
+    while stack:
+        children, output = stack[-1]
+        for child in children:
+            kind = _FLATTEN_KINDS.get(child.__class__)
+            if kind is None:
+                kind = _flatten_kind(child.__class__)
+            if kind == _LEAF:
+                if table is not None:
+                    child = table.intern(child)
+                output.append(child)
+            elif kind == _ELEMENT:
+                if copy:
+                    element, pending = getattr(child, '_open_copy',
+                                               child._open)()
+                else:
+                    element, pending = child._open()
+                output.append(element)
+                stack.append((iter(pending), element.children))
+                break
+            elif kind == _INLINE:
+                stack.append((iter(child._inline()), output))
+                break
+            else:
+                output.extend(child._flatten())
+        else:
+            stack.pop()
+    return result
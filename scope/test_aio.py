@@ -0,0 +1,20 @@
+#
+# test_aio.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+# pylint: disable=C0111
+
+import sys
+import unittest
+
+# The tests use asynchronous generators and asyncio.run, and can't even be
+# compiled by older versions of Python.
+if sys.version_info >= (3, 7):
+    from ._aio_cases import TestAsyncSerialization  # pylint: disable=W0611
+
+
+if __name__ == '__main__':
+    unittest.main()
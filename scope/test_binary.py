@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+# test_binary.py
+#
+# Copyright (c) 2013 Luis Garcia.
+# This source file is subject to terms of the MIT License. (See file LICENSE)
+#
+
+# pylint: disable=C0111
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from . import scope
+from . import binary
+from .test_scope import mock_tag, MockTag
+
+
+@unittest.skipIf(sys.version_info < (3, 0),
+                 'The binary format requires Python 3.')
+class TestBinaryFormat(unittest.TestCase):  # pylint: disable-msg=R0904
+    def _template(self):
+        return mock_tag(name='parent')[
+            mock_tag(name='child')['a', 1, 2.5],
+            scope.indent[
+                scope.for_each(range(0, 3), lambda n: 'item-{0}'.format(n),
+                               lazy=True)
+            ],
+            scope.new_line,
+            u'é'
+        ]
+
+    def _dump(self, template):
+        fileobj = io.BytesIO()
+        binary.dump(template, fileobj)
+        fileobj.seek(0)
+        return fileobj
+
+    def test_dump_1(self):
+        template = self._template()
+
+        loaded = binary.load(self._dump(template))
+
+        self.assertTrue(isinstance(loaded, binary.BinaryTemplate))
+        self.assertEqual(scope.flatten(loaded),
+                         scope.freeze(self._template()))
+        self.assertEqual(scope.serialize(loaded),
+                         scope.serialize(self._template()))
+
+    def test_dump_2(self):
+        element = MockTag(name='element')
+        element.attributes = {'list': [1, None], 'tuple': (True, False)}
+        shared = scope.freeze(mock_tag(name='shared')['x'])
+        template = scope.flatten(mock_tag(name='parent')[
+            shared, element, shared
+        ])
+
+        loaded = scope.flatten(binary.load(self._dump(template)))
+
+        self.assertEqual(loaded, template)
+        self.assertEqual(loaded.children[1].attributes,
+                         {'list': [1, None], 'tuple': (True, False)})
+        self.assertTrue(len(self._dump(template).getvalue()) <
+                        len(self._dump(mock_tag(name='parent')[
+                            mock_tag(name='shared')['x'], element,
+                            mock_tag(name='other')['x']
+                        ]).getvalue()))
+
+    def test_dump_3(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'template.bin')
+            template = mock_tag(name='parent')[
+                scope.for_each(range(0, 1000), lambda n: mock_tag(
+                    name='child-{0}'.format(n)
+                )['line-{0}'.format(n)])
+            ]
+            with open(path, 'wb') as f:
+                f.write(b'data')
+                binary.dump(template, f)
+
+            with open(path, 'rb') as f:
+                f.read(4)
+                with binary.load(f) as loaded:
+                    self.assertEqual(scope.serialize(loaded, fused=True),
+                                     scope.serialize(template))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dump_4(self):
+        class LocalTag(scope.TagBase):
+            pass
+
+        self.assertRaises(TypeError, binary.dump, scope.Tag(LocalTag),
+                          io.BytesIO())
+        self.assertRaises(ValueError, binary.load,
+                          io.BytesIO(b'not a binary template' * 4))
+
+    def test_dump_5(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'template.bin')
+            text_path = os.path.join(directory, 'text.bin')
+            with open(path, 'wb') as f:
+                binary.dump(self._template(), f)
+            with open(text_path, 'wb') as f:
+                binary.dump('text', f)
+
+            with open(path, 'rb') as f:
+                loaded = binary.load(f)
+                loaded.close()
+            with open(text_path, 'rb') as f:
+                text = binary.load(f)
+
+            self.assertRaises(ValueError, scope.serialize, loaded)
+            self.assertEqual(text, 'text')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_exports_1(self):
+        from . import dump, load
+        self.assertTrue(dump is binary.dump)
+        self.assertTrue(load is binary.load)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,7 +7,16 @@
 
 # pylint: disable=C0111
 
+import os
+import shutil
+import tempfile
 import unittest
+
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None  # pylint: disable-msg=C0103
+
 from . import scope
 
 class MockTag(scope.TagBase):
@@ -29,6 +38,19 @@ class MockTag(scope.TagBase):
 mock_tag = scope.Tag(MockTag)  # pylint: disable-msg=C0103
 
 
+# Sink accepting the native strings of both Python 2 and 3, unlike
+# io.StringIO.
+class ListSink(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, string):
+        self.writes.append(string)
+
+    def getvalue(self):
+        return ''.join(self.writes)
+
+
 class TestBaseLibrary(unittest.TestCase):  # pylint: disable-msg=R0904
     def test_tag_handler_1(self):
         template = mock_tag(name='element')
@@ -122,6 +144,79 @@ class TestBaseLibrary(unittest.TestCase):  # pylint: disable-msg=R0904
 
         self.assertEqual(scope.flatten(template), expected)
 
+    def test_tag_for_each_lazy_1(self):
+        consumed = []
+
+        def generate():
+            for n in range(1, 4):
+                consumed.append(n)
+                yield n
+
+        template = mock_tag(name='parent')[
+            scope.for_each(
+                generate(),
+                lambda n: mock_tag(name='child-{0}'.format(n))[
+                    scope.span['a', 'b']
+                ],
+                lazy=True
+            )
+        ]
+
+        flattened = scope.flatten(template)
+        self.assertEqual(len(flattened.children), 1)
+        self.assertEqual(consumed, [])
+
+        expected = ('parent\n'
+                    '    child-1\n        a\n        b\n'
+                    '    child-2\n        a\n        b\n'
+                    '    child-3\n        a\n        b\n')
+
+        self.assertEqual(scope.serialize(flattened), expected)
+        self.assertEqual(consumed, [1, 2, 3])
+
+    def test_tag_for_each_lazy_2(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(
+                range(0, 2),
+                lambda i: scope.for_each(
+                    range(0, 2),
+                    lambda j: 'item-{0}-{1}'.format(i, j),
+                    lazy=True
+                ),
+                lazy=True
+            )
+        ]
+
+        expected = ('parent\n    item-0-0\n    item-0-1\n'
+                    '    item-1-0\n    item-1-1\n')
+
+        self.assertEqual(scope.serialize(template), expected)
+
+    @unittest.skipIf(concurrent is None, 'concurrent.futures is missing.')
+    def test_tag_for_each_lazy_3(self):
+        def template():
+            return mock_tag(name='parent')[
+                mock_tag(name='child')[
+                    scope.for_each(range(0, 2),
+                                   lambda n: 'item-{0}'.format(n), lazy=True)
+                ],
+                scope.for_each(range(0, 2),
+                               lambda n: mock_tag(name='lazy-{0}'.format(n)),
+                               lazy=True)
+            ]
+
+        expected = scope.serialize(template())
+
+        self.assertEqual(scope.serialize_many([template(), template()],
+                                              workers=2),
+                         [expected, expected])
+        self.assertEqual(scope.serialize(template(), workers=2), expected)
+
+        tree = scope.flatten(template())
+        lazy = tree.children[0].children[0]
+        self.assertEqual(scope.serialize_many([tree], workers=2), [expected])
+        self.assertTrue(tree.children[0].children[0] is lazy)
+
     def test_tag_span_1(self):
         template = mock_tag(name='parent')[
             scope.span[
@@ -271,6 +366,184 @@ class TestBaseLibrary(unittest.TestCase):  # pylint: disable-msg=R0904
 
         self.assertEqual(scope.flatten(template), expected)
 
+    def test_flatten_deep_1(self):
+        depth = 10000
+        template = 'leaf'
+        for _ in range(0, depth):
+            template = mock_tag(name='node')[
+                scope.span[scope.for_each([template], lambda t: t)]
+            ]
+
+        element = scope.flatten(template)
+        for _ in range(0, depth):
+            self.assertEqual(element.name, 'node')
+            self.assertEqual(len(element.children), 1)
+            element = element.children[0]
+
+        self.assertEqual(element, 'leaf')
+
+    def test_structural_hash_1(self):
+        first = scope.flatten(mock_tag(name='parent')[
+            mock_tag(name='a')['x'],
+            mock_tag(name='b')
+        ])
+        second = scope.flatten(mock_tag(name='parent')[
+            mock_tag(name='a')['x'],
+            mock_tag(name='b')
+        ])
+        third = scope.flatten(mock_tag(name='parent')[
+            mock_tag(name='a')['y'],
+            mock_tag(name='b')
+        ])
+
+        self.assertEqual(hash(first), hash(second))
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, third)
+        self.assertEqual(len(set([first, second, third])), 2)
+        self.assertNotEqual(first, 'parent')
+
+    def test_structural_hash_2(self):
+        element = scope.flatten(mock_tag(name='parent')['a'])
+        value = hash(element)
+
+        element.children = ['b']
+        self.assertNotEqual(hash(element), value)
+
+        element.set_children(['a'], True)
+        self.assertEqual(hash(element), value)
+
+    def test_structural_hash_3(self):
+        self.assertNotEqual(MockTag(), scope.IndentTag())
+
+    def test_structural_hash_4(self):
+        def deep(leaf):
+            template = leaf
+            for _ in range(0, 10000):
+                template = mock_tag(name='node')[template]
+            return scope.flatten(template)
+
+        self.assertEqual(hash(deep('a')), hash(deep('a')))
+        self.assertEqual(deep('a'), deep('a'))
+        self.assertNotEqual(deep('a'), deep('b'))
+
+    def test_compact_representation_1(self):
+        import pickle
+
+        element = scope.flatten(mock_tag(name='parent')[
+            scope.indent['a'],
+            mock_tag(name='child')
+        ])
+
+        self.assertEqual(element.__dict__, {'_name': 'parent'})
+        self.assertFalse(hasattr(element.children[0], '__dict__'))
+        self.assertEqual(element.children[1].children, [])
+
+        copy = pickle.loads(pickle.dumps(element))
+        self.assertEqual(copy, element)
+        self.assertEqual(copy.name, 'parent')
+
+    def test_compact_representation_2(self):
+        first = MockTag(name='first')
+        second = MockTag(name='second')
+        first.children.append('a')
+
+        self.assertEqual(first.children, ['a'])
+        self.assertEqual(second.children, [])
+
+        flattened = scope.flatten(mock_tag(name='x'))
+        flattened.children.append('a')
+        self.assertEqual(flattened.children, ['a'])
+        self.assertEqual(scope.freeze(mock_tag(name='x')).children, ())
+
+    def test_freeze_1(self):
+        child = mock_tag(name='child')['x']
+        template = mock_tag(name='parent')[
+            child,
+            scope.for_each(range(0, 2), lambda n: 'item-{0}'.format(n),
+                           lazy=True),
+            scope.indent[child]
+        ]
+
+        frozen = scope.freeze(template)
+
+        self.assertTrue(frozen.frozen)
+        self.assertEqual(frozen.children[:3],
+                         (MockTag(name='child').set_children(['x'], True),
+                          'item-0', 'item-1'))
+        self.assertTrue(isinstance(frozen.children[0].children, tuple))
+        self.assertFalse(scope.flatten(template).frozen)
+        self.assertEqual(scope.serialize(frozen), scope.serialize(template))
+        self.assertEqual(scope.serialize(frozen), scope.serialize(frozen))
+
+    def test_freeze_2(self):
+        frozen = scope.freeze(mock_tag(name='parent')[mock_tag(name='child')])
+
+        def modify():
+            frozen.children[0].children = ['a']
+
+        self.assertRaises(RuntimeError, modify)
+        self.assertRaises(RuntimeError, frozen.set_children, [], False)
+
+    def test_freeze_3(self):
+        import pickle
+
+        shared = scope.freeze(mock_tag(name='shared')['a'])
+        frozen = scope.freeze(mock_tag(name='parent')[shared, shared])
+
+        self.assertTrue(frozen.children[0] is shared)
+        self.assertTrue(frozen.children[1] is shared)
+        self.assertTrue(scope.freeze(frozen) is frozen)
+
+        copy = pickle.loads(pickle.dumps(frozen))
+        self.assertTrue(copy.frozen)
+        self.assertEqual(copy, frozen)
+        self.assertEqual(scope.serialize(copy), scope.serialize(frozen))
+
+    def test_intern_table_1(self):
+        import pickle
+
+        table = scope.InternTable()
+        first = ''.join(['na', 'me'])
+        second = ''.join(['n', 'ame'])
+
+        self.assertTrue(scope.intern(first) is first)
+        with table:
+            self.assertTrue(scope.intern(first) is first)
+            self.assertTrue(scope.intern(second) is first)
+            self.assertEqual(scope.intern([second, 1]), ['name', 1])
+            self.assertTrue(scope.intern((second,)) is
+                            scope.intern((first,)))
+        self.assertTrue(scope.intern(second) is second)
+        self.assertTrue('name' in table)
+        self.assertEqual(len(pickle.loads(pickle.dumps(table))), 0)
+
+        table.clear()
+        self.assertEqual(len(table), 0)
+
+    def test_intern_table_2(self):
+        def template():
+            return mock_tag(name='parent')[
+                scope.for_each(range(0, 3), lambda n: ''.join(['a', 'b'])),
+                scope.for_each(range(0, 2), lambda n: ''.join(['a', 'b']),
+                               lazy=True)
+            ]
+
+        table = scope.InternTable()
+        with table:
+            element = scope.flatten(template())
+            frozen = scope.freeze(template())
+
+        self.assertTrue(all(child is element.children[0]
+                            for child in element.children[:3]))
+        self.assertTrue(all(child is element.children[0]
+                            for child in frozen.children))
+
+        options = scope.SerializerOptions()
+        options.intern_table = scope.InternTable()
+        self.assertEqual(scope.serialize(template(), options),
+                         scope.serialize(template()))
+        self.assertEqual(len(options.intern_table), 1)
+
     def test_serialization_1(self):
         template = mock_tag(name='element')
 
@@ -368,5 +641,410 @@ class TestBaseLibrary(unittest.TestCase):  # pylint: disable-msg=R0904
 
         self.assertEqual(scope.serialize(template), expected)
 
+    def test_serializer_context_1(self):
+        context = scope.SerializerContext(scope.SerializerOptions())
+        self.assertEqual(context.output, '')
+
+        context.write('a')
+        context.indent()
+        context.write('b')
+        self.assertEqual(context.output, 'a\n    b\n')
+        self.assertEqual(context.output, 'a\n    b\n')
+
+        context.new_line()
+        context.unindent()
+        context.write('c')
+        self.assertEqual(context.output, 'a\n    b\n\nc\n')
+
+    def test_serialization_11(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 1000), lambda n: 'line-{0}'.format(n))
+        ]
+
+        expected = 'parent\n' + ''.join(
+            '    line-{0}\n'.format(n) for n in range(0, 1000))
+
+        self.assertEqual(scope.serialize(template), expected)
+
+    def test_serialization_12(self):
+        class FailingTag(scope.TagBase):
+            def serialize(self, context):
+                raise TypeError('failure')
+
+        template = mock_tag(name='parent')[scope.Tag(FailingTag)]
+
+        self.assertRaises(TypeError, scope.serialize, template)
+
+    def test_serialization_13(self):
+        class CustomValue(object):
+            def __str__(self):
+                return 'custom'
+
+        template = mock_tag(name='parent')[CustomValue()]
+        expected = 'parent\n    custom\n'
+
+        self.assertEqual(scope.serialize(template), expected)
+
+    def test_render_cache_1(self):
+        calls = []
+
+        class CountingTag(MockTag):
+            def serialize(self, context):
+                calls.append(self.name)
+                super(CountingTag, self).serialize(context)
+
+        shared = scope.flatten(scope.Tag(CountingTag)(name='shared')[
+            'a', 'b'
+        ])
+        template = mock_tag(name='parent')[
+            shared,
+            scope.indent[shared],
+            shared
+        ]
+
+        cache = scope.RenderCache()
+        output = scope.serialize(template, cache=cache)
+
+        self.assertEqual(calls, ['shared', 'shared'])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(output, scope.serialize(template))
+
+        del calls[:]
+        self.assertEqual(scope.serialize(template, cache=cache), output)
+        self.assertEqual(calls, [])
+
+    def test_render_cache_2(self):
+        cache = scope.RenderCache(maxsize=2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 'a')
+        self.assertEqual(cache.get(3), 'c')
+        self.assertEqual(cache.currsize, 2)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+        cache.clear()
+        self.assertEqual((cache.currsize, cache.hits, cache.misses), (0, 0, 0))
+
+    def test_render_cache_3(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 3000), lambda n: mock_tag(name='a')['b'])
+        ]
+
+        output = ListSink()
+        scope.serialize_to(template, output, cache=scope.RenderCache())
+
+        self.assertEqual(output.getvalue(), scope.serialize(template))
+
+    def test_render_cache_4(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 10), lambda n: mock_tag(name='a')['b'])
+        ]
+
+        cache = scope.RenderCache(structural=True)
+        output = scope.serialize(template, cache=cache)
+
+        self.assertEqual(output, scope.serialize(template))
+        self.assertEqual((cache.hits, cache.misses), (9, 2))
+
+    def test_render_cache_5(self):
+        items = ['a']
+        template = mock_tag(name='parent')[
+            scope.for_each(items, lambda item: mock_tag(name=item))
+        ]
+        cache = scope.RenderCache()
+
+        self.assertEqual(scope.serialize(template, cache=cache),
+                         'parent\n    a\n')
+        items.append('b')
+        self.assertEqual(scope.serialize(template, cache=cache),
+                         'parent\n    a\n    b\n')
+
+    def test_serialization_14(self):
+        options = scope.SerializerOptions()
+        options.indentation_factor = 2
+        options.tab_size = 4
+
+        template = mock_tag(name='a')[
+            mock_tag(name='b')[
+                mock_tag(name='c')[
+                    'd'
+                ]
+            ]
+        ]
+
+        expected = 'a\n  b\n\tc\n\t  d\n'
+
+        self.assertEqual(scope.serialize(template, options), expected)
+
+    def test_serialization_15(self):
+        options = scope.SerializerOptions()
+        options.max_indentation_level = 1
+
+        self.assertEqual(scope.serialize(mock_tag(name='a')['b'], options),
+                         'a\n    b\n')
+        self.assertRaises(ValueError, scope.serialize,
+                          mock_tag(name='a')[mock_tag(name='b')['c']],
+                          options)
+
+    def test_serializer_context_3(self):
+        context = scope.SerializerContext(scope.SerializerOptions())
+        context.indent()
+        context.write_block('a\nb\n\nc\n')
+        context.write_block('')
+        context.unindent()
+        context.write_block('d')
+
+        self.assertEqual(context.output, '    a\n    b\n    \n    c\nd\n')
+        self.assertEqual(context.indentation, 0)
+
+    def test_hooks_1(self):
+        events = []
+
+        class Hooks(scope.SerializerHooks):
+            def before_serialize(self, context, tag):
+                events.append(('before', str(tag)[:7], context.written))
+
+            def after_serialize(self, context, tag):
+                events.append(('after', str(tag)[:7], context.written))
+
+        template = mock_tag(name='parent')[
+            'a',
+            scope.new_line
+        ]
+
+        output = scope.serialize(template, hooks=[Hooks()])
+
+        self.assertEqual(output, 'parent\n    a\n\n')
+        self.assertEqual(events, [
+            ('before', 'MockTag', 0),
+            ('before', 'a', 7),
+            ('after', 'a', 13),
+            ('before', 'NewLine', 13),
+            ('after', 'NewLine', 14),
+            ('after', 'MockTag', 14)
+        ])
+
+    def test_hooks_2(self):
+        collector = scope.TimingCollector()
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 10), lambda n: mock_tag(name='a')['b']),
+            scope.indent['c']
+        ]
+
+        output = scope.serialize(template, hooks=[collector],
+                                 cache=scope.RenderCache(structural=True))
+
+        self.assertEqual(output, scope.serialize(template))
+
+        statistics = collector.statistics
+        self.assertEqual(statistics[MockTag].count, 11)
+        # The output of the children is included in the parent.
+        self.assertEqual(statistics[MockTag].written, len(output) + 10 * 16)
+        self.assertEqual(statistics[scope.IndentTag].written, 10)
+        self.assertEqual(statistics[str].count, 2)
+        self.assertTrue(statistics[MockTag].total_time >=
+                        statistics[MockTag].own_time)
+        self.assertTrue('MockTag' in collector.report())
+
+    def test_hooks_3(self):
+        context = scope.SerializerContext(scope.SerializerOptions())
+        context.write('a')
+        self.assertEqual(context.written, None)
+
+    def test_serialize_to_1(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 3000), lambda n: 'line-{0}'.format(n))
+        ]
+
+        output = ListSink()
+        scope.serialize_to(template, output)
+
+        self.assertEqual(output.getvalue(), scope.serialize(template))
+
+    def test_serialize_to_2(self):
+        writes = []
+
+        class Sink(object):
+            def write(self, string):
+                writes.append(string)
+
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 3000), lambda n: 'line-{0}'.format(n))
+        ]
+
+        scope.serialize_to(template, Sink())
+
+        self.assertTrue(len(writes) > 1)
+        self.assertEqual(''.join(writes), scope.serialize(template))
+
+    def test_serializer_context_2(self):
+        context = scope.SerializerContext(scope.SerializerOptions(),
+                                          sink=ListSink())
+        context.write('a')
+        self.assertRaises(RuntimeError, lambda: context.output)
+
+    def test_emit_1(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'output.txt')
+
+            def template(count):
+                return mock_tag(name='parent')[
+                    scope.for_each(range(0, count),
+                                   lambda n: 'line-{0}'.format(n))
+                ]
+
+            self.assertEqual(scope.emit(template(3000), path),
+                             scope.EMIT_CREATED)
+            with open(path) as f:
+                self.assertEqual(f.read(), scope.serialize(template(3000)))
+
+            os.utime(path, (0, 0))
+            self.assertEqual(scope.emit(template(3000), path),
+                             scope.EMIT_UNCHANGED)
+            self.assertEqual(os.stat(path).st_mtime, 0)
+
+            for count in [2000, 2500, 3000]:
+                self.assertEqual(scope.emit(template(count), path),
+                                 scope.EMIT_UPDATED)
+                with open(path) as f:
+                    self.assertEqual(f.read(),
+                                     scope.serialize(template(count)))
+
+            self.assertEqual(os.listdir(directory), ['output.txt'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_emit_2(self):
+        class FailingTag(scope.TagBase):
+            def serialize(self, context):
+                raise ValueError('failure')
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'output.txt')
+            with open(path, 'w') as f:
+                f.write('previous\n')
+
+            template = mock_tag(name='parent')[scope.Tag(FailingTag)]
+
+            self.assertRaises(ValueError, scope.emit, template, path)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'previous\n')
+            self.assertEqual(os.listdir(directory), ['output.txt'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_emit_3(self):
+        directory = tempfile.mkdtemp()
+        mask = os.umask(0o027)
+        try:
+            path = os.path.join(directory, 'output.txt')
+            self.assertEqual(scope.emit(mock_tag(name='a'), path),
+                             scope.EMIT_CREATED)
+            if os.name != 'nt':
+                self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+
+            if hasattr(os, 'symlink'):
+                link = os.path.join(directory, 'link.txt')
+                os.symlink(path, link)
+                self.assertEqual(scope.emit(mock_tag(name='b'), link),
+                                 scope.EMIT_UPDATED)
+                self.assertTrue(os.path.islink(link))
+                with open(path) as f:
+                    self.assertEqual(f.read(), 'b\n')
+        finally:
+            os.umask(mask)
+            shutil.rmtree(directory)
+
+    def test_serialize_variants_1(self):
+        template = mock_tag(name='parent')[
+            scope.indent[mock_tag(name='child')['a']],
+            scope.new_line,
+            'b'
+        ]
+        tabs = scope.SerializerOptions()
+        tabs.tab_size = 4
+        narrow = scope.SerializerOptions()
+        narrow.indentation_factor = 2
+        limited = scope.SerializerOptions()
+        limited.max_indentation_level = 3
+        variants = [scope.SerializerOptions(), tabs, narrow, limited]
+
+        outputs = scope.serialize_variants(template, variants)
+
+        self.assertEqual(outputs, [scope.serialize(template, options)
+                                   for options in variants])
+        self.assertEqual(outputs[1], 'parent\n\t\tchild\n\t\t\ta\n\n\tb\n')
+        self.assertEqual(scope.serialize_variants(template, []), [])
+
+        limited.max_indentation_level = 2
+        self.assertRaises(ValueError, scope.serialize_variants, template,
+                          [limited])
+
+    def test_serialize_variants_2(self):
+        def rows():
+            for n in range(0, 3):
+                yield n
+
+        template = mock_tag(name='parent')[
+            scope.for_each(rows(), lambda n: 'row-{0}'.format(n), lazy=True)
+        ]
+        other = scope.SerializerOptions()
+        other.extras['variant'] = True
+
+        outputs = scope.serialize_variants(
+            template, [scope.SerializerOptions(), other])
+
+        expected = 'parent\n    row-0\n    row-1\n    row-2\n'
+        self.assertEqual(outputs, [expected, expected])
+
+    def test_iter_serialize_1(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 50000), lambda n: 'line-{0}'.format(n))
+        ]
+
+        chunks = list(scope.iter_serialize(template))
+
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(''.join(chunks), scope.serialize(template))
+
+    def test_iter_serialize_2(self):
+        class FailingTag(scope.TagBase):
+            def serialize(self, context):
+                raise ValueError('failure')
+
+        template = mock_tag(name='parent')[scope.Tag(FailingTag)]
+
+        self.assertRaises(ValueError, list, scope.iter_serialize(template))
+
+    def test_iter_serialize_4(self):
+        child = scope.flatten(mock_tag(name='child')['a'])
+        template = scope.flatten(mock_tag(name='parent')[
+            scope.for_each(range(0, 200000), lambda n: 'line-{0}'.format(n)),
+            child, child
+        ])
+        cache = scope.RenderCache()
+
+        chunks = list(scope.iter_serialize(template, cache=cache))
+
+        self.assertTrue(len(chunks) > 100)
+        self.assertEqual(''.join(chunks), scope.serialize(template))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.currsize, 1)
+
+    def test_iter_serialize_3(self):
+        template = mock_tag(name='parent')[
+            scope.for_each(range(0, 100000), lambda n: 'line-{0}'.format(n))
+        ]
+
+        chunks = scope.iter_serialize(template)
+        self.assertTrue(next(chunks).startswith('parent\n'))
+        chunks.close()
+
 if __name__ == '__main__':
     unittest.main()